@@ -0,0 +1,81 @@
+from collections import deque
+import numpy as np
+
+
+# Chooses the sampling step of the region-of-interest perception from the
+# measured perception time.  Steps are powers of two up to max_step: the
+# step is coarsened while the typical time at the current step is over
+# budget, and refined once the time last measured at the finer step fits
+# within refine_margin of the budget.  Typical times are the lower median
+# of the last frames, so one-off stalls such as the first frame do not
+# count.  Every check_interval frames the frame is perceived at full
+# resolution and the navigable terrain statistics of each coarser step are
+# compared with it; steps off by more than the tolerances are ruled out
+# until the next check.
+class ResolutionController():
+    def __init__(self, budget=0.005, max_step=4, angle_tolerance=2., count_tolerance=0.1,
+                 check_interval=25, window=9, refine_margin=0.7):
+        self.budget = budget # Perception time budget per frame in seconds
+        self.steps = [1 << idx for idx in range(int(np.log2(max_step)) + 1)] # Candidate steps
+        self.angle_tolerance = angle_tolerance # Degrees, on the mean and 10/90 percentiles of the navigable angles
+        self.count_tolerance = count_tolerance # Relative, on the navigable pixel count
+        self.check_interval = check_interval # Frames between full resolution checks
+        self.window = window # Frames per step the typical time is taken over
+        self.refine_margin = refine_margin # Fraction of the budget a finer step must fit in
+        self.step = 1 # Current step
+        self.allowed = 1 # Coarsest step within tolerance at the last check
+        self.times = {} # Step -> perception times in seconds of the last frames
+        self.errors = {} # Step -> (angle error, relative count error) at the last check
+        self.frames = 0
+        self.checking = False # The current frame is a full resolution check
+
+    # Step to perceive the next frame with
+    def next_step(self):
+        self.checking = self.frames % self.check_interval == 0
+        self.frames += 1
+        return 1 if self.checking else self.step
+
+    # Lower median of the last perception times at a step
+    def typical_time(self, step, default):
+        times = self.times.get(step)
+        if not times:
+            return default
+        return sorted(times)[(len(times) - 1)//2]
+
+    # Account the perception time of a frame perceived with the given step
+    # and adapt the step to the budget
+    def record(self, step, elapsed):
+        self.times.setdefault(step, deque(maxlen=self.window)).append(elapsed)
+        idx = self.steps.index(self.step)
+        if self.typical_time(self.step, 0) > self.budget and idx + 1 < len(self.steps) \
+                and self.steps[idx + 1] <= self.allowed:
+            self.step = self.steps[idx + 1]
+        elif idx > 0 and self.typical_time(self.steps[idx - 1], np.inf) < self.refine_margin*self.budget:
+            self.step = self.steps[idx - 1]
+
+    # Rule out the steps whose errors against the full resolution frame,
+    # a dict of step -> (angle error, relative count error), are too large
+    def validate(self, errors):
+        self.errors = errors
+        self.allowed = 1
+        for step in self.steps[1:]:
+            angle_error, count_error = errors[step]
+            if angle_error > self.angle_tolerance or count_error > self.count_tolerance:
+                break
+            self.allowed = step
+        self.step = min(self.step, self.allowed)
+
+
+# Mean and 10/90 percentiles in degrees, and count of a navigation summary
+def nav_statistics(summary):
+    if summary.count == 0:
+        return None, 0
+    return np.array([summary.mean, summary.percentile(10), summary.percentile(90)]), summary.count
+
+# Errors of the statistics of a sampled summary against the full resolution one
+def statistics_error(full, sampled):
+    (full_angles, full_count), (angles, count) = full, sampled
+    count_error = abs(count - full_count)/max(full_count, 1)
+    if full_angles is None or angles is None:
+        return (0. if full_angles is angles else np.inf), count_error
+    return float(np.max(np.abs(angles - full_angles))), count_error
@@ -0,0 +1,178 @@
+# Side-effect free perception over a whole stack of camera frames
+# Example: $ python batch_perception.py IMG_folder --workers 4
+import argparse
+import glob
+import os
+import time
+from multiprocessing import Pool
+import numpy as np
+import cv2
+
+from camera_model import CameraModel, pixel_table
+from pixel_classifier import PixelClassifier, ClassBuffers
+from perception import perspective_destination
+from run_store import RunReader, META_FILE
+from map_fusion import batch_rover_to_world
+
+SOURCE = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+
+# Models shared by the batches processed in this process
+camera = CameraModel()
+classifier = PixelClassifier()
+
+
+# Rover-frame pixels of many frames to clipped world map cells, the same
+# arithmetic as rotate_pix and translate_pix in perception.py with one
+# batched rotation for all frames, clipped to the map border
+def batch_pix_to_world(xpix, ypix, frame, xpos, ypos, yaw, world_size, scale):
+    xpix_tran, ypix_tran = batch_rover_to_world(xpix, ypix, frame, xpos, ypos, yaw, scale)
+    x_pix_world = np.clip(np.int_(xpix_tran), 0, world_size - 1)
+    y_pix_world = np.clip(np.int_(ypix_tran), 0, world_size - 1)
+    return x_pix_world, y_pix_world
+
+# Flat nonzero pixels of a mask stack, split into frame and in-frame pixel indices
+def stack_indices(masks):
+    frame_size = masks.shape[1]*masks.shape[2]
+    idx = np.flatnonzero(masks)
+    return idx // frame_size, idx % frame_size
+
+# Perceive a stack of (N, rows, cols, 3) RGB frames taken at the given poses.
+# Returns a dict with the stacked masks, per-frame navigable terrain
+# statistics and, for each map layer, the (frame, x, y) rover-frame and
+# world pixels that perception_step would add to the worldmap.
+def perceive_batch(images, xpos, ypos, yaw, pitch=None, roll=None, world_size=200,
+                   scale=10, max_pitch=2, max_roll=2, crop=20, rock_crop=30):
+    images = np.asarray(images)
+    n_frames = images.shape[0]
+    camera.calibrate(images.shape[1:3], SOURCE, perspective_destination(images.shape[1:3]))
+    # Warp every frame with the cached remap table
+    warped = np.empty_like(images)
+    for idx in range(n_frames):
+        camera.warp(images[idx], out=warped[idx])
+    # Classify the whole stack in one pass
+    buffers = ClassBuffers(warped.shape)
+    navigable, obstacle, rocks = classifier.classify(warped, camera.mask, buffers)
+
+    table = pixel_table(images.shape[1:3])
+    # Mapping is only valid for frames with the rover close to level
+    valid = np.ones(n_frames, dtype=bool)
+    if pitch is not None:
+        valid &= np.abs(np.asarray(pitch, dtype=np.float64)) < max_pitch
+    if roll is not None:
+        valid &= np.abs(np.asarray(roll, dtype=np.float64)) < max_roll
+
+    result = {'navigable': navigable, 'obstacle': obstacle, 'rocks': rocks}
+    for name, masks, crop_value in (('nav', navigable, crop), ('obs', obstacle, crop),
+                                    ('rock', rocks, rock_crop)):
+        frame, pix = stack_indices(masks)
+        if name != 'obs':
+            # Polar statistics of all the pixels, as used for steering
+            count = np.bincount(frame, minlength=n_frames)
+            angle_sum = np.bincount(frame, weights=table.angle[pix], minlength=n_frames)
+            dist_sum = np.bincount(frame, weights=table.dist[pix], minlength=n_frames)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result[name + '_count'] = count
+                result[name + '_mean_angle'] = angle_sum / count
+                result[name + '_mean_dist'] = dist_sum / count
+        # World pixels of the cropped area of the valid frames
+        xpix = table.x[pix]
+        keep = (xpix < crop_value) & valid[frame]
+        frame = frame[keep]
+        xpix = xpix[keep]
+        ypix = table.y[pix][keep]
+        x_world, y_world = batch_pix_to_world(xpix, ypix, frame, xpos, ypos, yaw, world_size, scale)
+        result[name + '_rover'] = (frame, xpix, ypix)
+        result[name + '_world'] = (frame, x_world, y_world)
+    return result
+
+def perceive_shard(args):
+    offset, images, xpos, ypos, yaw, pitch, roll, kwargs = args
+    result = perceive_batch(images, xpos, ypos, yaw, pitch, roll, **kwargs)
+    for name in ('nav', 'obs', 'rock'):
+        for suffix in ('_rover', '_world'):
+            frame, xpix, ypix = result[name + suffix]
+            result[name + suffix] = (frame + offset, xpix, ypix)
+    return result
+
+# Concatenate shard results along the frame dimension
+def merge_results(results):
+    merged = {}
+    for key in results[0]:
+        if key.endswith('_world') or key.endswith('_rover'):
+            merged[key] = tuple(np.concatenate([r[key][i] for r in results]) for i in range(3))
+        else:
+            merged[key] = np.concatenate([r[key] for r in results])
+    return merged
+
+# Same as perceive_batch, sharding the frames across worker processes.
+# Frame indices start at offset, for images that are a block of a longer run.
+def perceive_batch_parallel(images, xpos, ypos, yaw, pitch=None, roll=None,
+                            workers=None, shard_size=256, offset=0, **kwargs):
+    workers = workers or os.cpu_count()
+    n_frames = len(images)
+    def optional(values, start, end):
+        return None if values is None else np.asarray(values)[start:end]
+    shards = []
+    for start in range(0, n_frames, shard_size):
+        end = min(start + shard_size, n_frames)
+        shards.append((offset + start, images[start:end], np.asarray(xpos)[start:end], np.asarray(ypos)[start:end],
+                       np.asarray(yaw)[start:end], optional(pitch, start, end),
+                       optional(roll, start, end), kwargs))
+    if workers <= 1 or len(shards) == 1:
+        return merge_results([perceive_shard(shard) for shard in shards])
+    with Pool(workers) as pool:
+        return merge_results(pool.map(perceive_shard, shards))
+
+# Load the JPEG frames saved by drive_rover.py image_folder as an RGB stack
+def load_image_folder(path):
+    filenames = sorted(glob.glob(os.path.join(path, '*.jpg')))
+    images = [cv2.cvtColor(cv2.imread(filename), cv2.COLOR_BGR2RGB) for filename in filenames]
+    return np.stack(images) if images else np.zeros((0, 160, 320, 3), dtype=np.uint8)
+
+# Load the frames and poses of a telemetry log recorded with drive_rover.py --record
+def load_telemetry_log(path):
+    from telemetry_log import read_telemetry
+    from supporting_functions import decode_image, detect_float_parser, convert_to_float
+    images, poses = [], []
+    for data in read_telemetry(path):
+        to_float = detect_float_parser(data) or convert_to_float
+        images.append(decode_image(data['image'])[0])
+        xpos, ypos = [to_float(pos) for pos in data['position'].split(';')]
+        poses.append((xpos, ypos, to_float(data['yaw']), to_float(data['pitch']), to_float(data['roll'])))
+    poses = np.array(poses).reshape(-1, 5)
+    # Pitch and roll are compared around zero, as in perception_step
+    poses[:, 3:] = (poses[:, 3:] + 180) % 360 - 180
+    return np.stack(images), poses
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch perception over recorded frames')
+    parser.add_argument('source', type=str,
+                        help='Telemetry log (--record), memory-mapped run folder (--record_format memmap) '
+                             'or folder of JPEG frames (no poses).')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes.')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if os.path.exists(os.path.join(args.source, META_FILE)):
+        # Memory-mapped run, the frames are processed straight from the chunk files
+        run = RunReader(args.source)
+        telemetry = run.telemetry()
+        poses = np.stack([telemetry[key] for key in ('x', 'y', 'yaw', 'pitch', 'roll')], axis=1)
+        poses[:, 3:] = (poses[:, 3:] + 180) % 360 - 180
+        images = run
+        results, offset = [], 0
+        for block in run.frame_blocks():
+            block_poses = poses[offset:offset + len(block)]
+            results.append(perceive_batch_parallel(block, *block_poses.T, workers=args.workers, offset=offset))
+            offset += len(block)
+        result = merge_results(results)
+    else:
+        if os.path.isdir(args.source):
+            images = load_image_folder(args.source)
+            poses = np.zeros((len(images), 5))
+        else:
+            images, poses = load_telemetry_log(args.source)
+        result = perceive_batch_parallel(images, *poses.T, workers=args.workers)
+    elapsed = time.perf_counter() - start
+    print('{} frames in {:.2f} s, {:.1f} frames/s, {} navigable world pixels'.format(
+        len(images), elapsed, len(images)/max(elapsed, 1e-9), len(result['nav_world'][0])))
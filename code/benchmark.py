@@ -0,0 +1,79 @@
+# Micro benchmarks for the per-frame perception stages
+# Example: $ python benchmark.py ../calibration_images/*.jpg
+import argparse
+import time
+import numpy as np
+import matplotlib.image as mpimg
+
+import perception
+from perception_kernels import KERNELS
+from rover_state import RoverState
+from profiling import NULL_TIMER
+
+
+# Time a callable over a list of arguments, return the mean time per call in ms
+def time_call(func, args_list, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for args in args_list:
+            func(*args)
+    return 1000*(time.perf_counter() - start)/(repeats*len(args_list))
+
+# Step 3 of perception_step: separate thresholds vs fused classifier
+def bench_threshold(warped_list, repeats):
+    def separate(warped, mask):
+        perception.color_thresh(warped)
+        perception.obstacle_thresh(warped, mask)
+        perception.rocks_thresh(warped)
+    # Check both paths agree before timing them
+    for warped, mask in warped_list:
+        nav, obs, rocks = perception.classify_pixels(warped, mask)
+        assert np.array_equal(nav, perception.color_thresh(warped))
+        assert np.array_equal(obs, perception.obstacle_thresh(warped, mask))
+        assert np.array_equal(rocks, perception.rocks_thresh(warped))
+    return {'separate thresholds': time_call(separate, warped_list, repeats),
+            'fused classifier': time_call(perception.classify_pixels, warped_list, repeats)}
+
+# Full frame perception: NumPy path vs fused kernel
+def bench_kernels(images, repeats):
+    Rover = RoverState()
+    Rover.pos = [100., 100.]
+    Rover.yaw = 45.
+    def run(perceive, img):
+        Rover.img = img
+        if perceive is perception.perceive_fused:
+            perceive(Rover, True, NULL_TIMER)
+        else:
+            perceive(Rover, NULL_TIMER)
+    args_list = [(perception.perceive_full, img) for img in images]
+    times = {'numpy perception': time_call(run, args_list, repeats)}
+    if KERNELS:
+        args_list = [(perception.perceive_fused, img) for img in images]
+        times['fused kernel'] = time_call(run, args_list, repeats)
+    return times
+
+def load_images(paths):
+    return [np.uint8(mpimg.imread(path)) for path in paths]
+
+def load_warped(paths):
+    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+    warped_list = []
+    for path in paths:
+        img = np.uint8(mpimg.imread(path))
+        destination = perception.perspective_destination(img.shape)
+        warped_list.append(perception.perspect_transform(img, source, destination))
+    return warped_list
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Perception micro benchmarks')
+    parser.add_argument('images', type=str, nargs='*', help='Camera images to process.')
+    parser.add_argument('--repeats', type=int, default=50, help='Passes over the image set.')
+    args = parser.parse_args()
+
+    if args.images:
+        images = load_images(args.images)
+        warped_list = load_warped(args.images)
+        times = bench_threshold(warped_list, args.repeats)
+        times.update(bench_kernels(images, args.repeats))
+        for name, ms in times.items():
+            print('{:<22s} {:8.3f} ms/frame'.format(name, ms))
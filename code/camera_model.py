@@ -0,0 +1,130 @@
+import threading
+import numpy as np
+import cv2
+
+from nav_summary import pixel_weights, pixel_sums
+
+
+# Calibrated camera model: holds the homography between the rover camera
+# and the top-down view, together with every per-shape quantity derived
+# from it. Everything is computed once and reused until either the image
+# shape or the calibration points change.
+class CameraModel():
+    def __init__(self):
+        self.key = None # (shape, src, dst) the cached values belong to
+        self.shape = None # Image shape (rows, cols) the model was built for
+        self.M = None # Perspective transform camera -> top-down
+        self.Minv = None # Inverse transform top-down -> camera
+        self.mask = None # Warped visibility mask (1 where the camera sees)
+        self.map1 = None # cv2.remap lookup table (fixed point coordinates)
+        self.map2 = None # cv2.remap lookup table (interpolation weights)
+        self.regions = {} # Warp regions of the current calibration, by window
+
+    # Rebuild the cached model only if the shape or calibration changed
+    def calibrate(self, shape, src, dst):
+        src = np.float32(src)
+        dst = np.float32(dst)
+        key = (tuple(shape[:2]), src.tobytes(), dst.tobytes())
+        if key == self.key:
+            return self
+        rows, cols = shape[:2]
+        self.M = cv2.getPerspectiveTransform(src, dst)
+        self.Minv = cv2.getPerspectiveTransform(dst, src)
+        # For every destination pixel find the source pixel it comes from
+        xgrid, ygrid = np.meshgrid(np.arange(cols, dtype=np.float32),
+                                   np.arange(rows, dtype=np.float32))
+        map_x, map_y = self.inverse_map(xgrid, ygrid)
+        # Fixed point maps are noticeably faster to evaluate in cv2.remap
+        self.map1, self.map2 = cv2.convertMaps(map_x, map_y, cv2.CV_16SC2)
+        # The mask never changes for a given calibration, warp it only once
+        self.mask = cv2.warpPerspective(np.ones((rows, cols), dtype=np.uint8),
+                                        self.M, (cols, rows))
+        self.shape = (rows, cols)
+        self.regions = {}
+        self.key = key
+        return self
+
+    # Project top-down pixel coordinates back to camera pixel coordinates
+    def inverse_map(self, xdst, ydst):
+        Minv = self.Minv
+        w = Minv[2,0]*xdst + Minv[2,1]*ydst + Minv[2,2]
+        # Points on the horizon line would divide by zero, send them off-image
+        w = np.where(np.abs(w) < 1e-12, 1e-12, w)
+        xsrc = (Minv[0,0]*xdst + Minv[0,1]*ydst + Minv[0,2]) / w
+        ysrc = (Minv[1,0]*xdst + Minv[1,1]*ydst + Minv[1,2]) / w
+        return np.float32(xsrc), np.float32(ysrc)
+
+    # Warp a camera image to the top-down view using the precomputed table
+    def warp(self, img, out=None):
+        return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR,
+                         dst=out, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+    # Warp region of a window of the top-down image, rows and cols being
+    # slices of its rows and columns
+    def region(self, rows, cols):
+        key = (rows.start, rows.stop, rows.step, cols.start, cols.stop, cols.step)
+        if key not in self.regions:
+            self.regions[key] = WarpRegion(self, rows, cols)
+        return self.regions[key]
+
+
+# A window of the top-down view warped on its own, possibly strided to
+# sample it at a lower resolution.  The remap tables are sliced from the
+# full ones, so every warped pixel is exactly the full warp at that position.
+class WarpRegion():
+    def __init__(self, camera, rows, cols):
+        self.rows = rows # Row slice of the top-down image
+        self.cols = cols # Column slice of the top-down image
+        self.map1 = np.ascontiguousarray(camera.map1[rows, cols])
+        self.map2 = np.ascontiguousarray(camera.map2[rows, cols])
+        self.mask = np.ascontiguousarray(camera.mask[rows, cols])
+        self.table = RoverPixelTable(camera.shape, rows, cols) # Rover-frame coordinates of the window
+
+    def warp(self, img, out=None):
+        return cv2.remap(img, self.map1, self.map2, cv2.INTER_LINEAR,
+                         dst=out, borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+
+# Rover-frame coordinates of every pixel of the top-down image, or of a
+# window of it given by row and column slices.  The grid is fixed, so
+# positions, distances and angles are computed once and each frame only
+# gathers the entries selected by a binary mask.
+class RoverPixelTable():
+    def __init__(self, shape, row_slice=slice(None), col_slice=slice(None)):
+        rows, cols = shape[:2]
+        self.shape = (rows, cols)
+        ypos, xpos = np.meshgrid(np.arange(rows)[row_slice], np.arange(cols)[col_slice], indexing='ij')
+        # Rover at the center bottom of the image, x forward and y to the left
+        x = -(ypos - rows).astype(np.float64)
+        y = -(xpos - cols/2).astype(np.float64)
+        self.x = np.float32(x).ravel() # Forward distance in pixels
+        self.y = np.float32(y).ravel() # Lateral distance in pixels
+        self.dist = np.float32(np.sqrt(x**2 + y**2)).ravel() # Distance in pixels
+        self.angle = np.float32(np.arctan2(y, x)).ravel() # Angle from the x axis in radians
+        self.sector, self.weights = pixel_weights(self.angle, self.dist) # Navigation summary sector and weights
+
+    # Flat indices of the nonzero pixels of a mask
+    def indices(self, binary_img):
+        return np.flatnonzero(binary_img)
+
+    def coords(self, idx):
+        return self.x[idx], self.y[idx]
+
+    def polar(self, idx):
+        return self.dist[idx], self.angle[idx]
+
+    # Navigation summary sums of the selected pixels
+    def sums(self, idx):
+        return pixel_sums(self.sector, self.weights, idx)
+
+
+# Tables are shared between callers working on the same image shape,
+# including concurrent ones, and never written to once built
+pixel_tables = {}
+pixel_tables_lock = threading.Lock()
+def pixel_table(shape):
+    key = tuple(shape[:2])
+    with pixel_tables_lock:
+        if key not in pixel_tables:
+            pixel_tables[key] = RoverPixelTable(key)
+        return pixel_tables[key]
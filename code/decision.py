@@ -1,8 +1,8 @@
+from abc import ABC, abstractmethod
 import numpy as np
-from supporting_functions import wrap_angle_180
-import time
-
-flag_print = 0;
+from supporting_functions import wrap_angle_180, logger
+from profiling import profiler
+from occupancy_grid import NAVIGABLE
 
 # Compute reference yaw when searching a rock
 def compute_yawref(Rover):
@@ -15,16 +15,61 @@ def compute_yawref(Rover):
 # Orientation controller
 def control_yaw(Rover):
     
-    ctrl_steer = Rover.Kp_yaw*wrap_angle_180(Rover.yawref - Rover.nyaw)
+    ctrl_steer = Rover.config.Kp_yaw*wrap_angle_180(Rover.yawref - Rover.nyaw)
     Rover.steer = np.clip(ctrl_steer,-15,15)
     return Rover
 
+# Steer towards the selected exploration frontier, keeping the heading
+# within the spread of the navigable terrain in sight
+def control_frontier(Rover, heading):
+    low, high = Rover.nav.percentile(10), Rover.nav.percentile(90)
+    angle = np.clip(wrap_angle_180(heading - Rover.nyaw), low, high)
+    Rover.yawref = wrap_angle_180(Rover.nyaw + angle)
+    return control_yaw(Rover)
+
+# Cell of a world position in meters
+def world_cell(worldmap, pos):
+    return tuple(int(cell) for cell in worldmap.world_to_cells(pos[0], pos[1]))
+
+# Order the located samples left to collect and set the goal: the first
+# sample of the route, or the start position once every sample has been
+# collected or there are no frontiers left to explore
+def update_route(Rover):
+    worldmap = Rover.worldmap
+    rover_cell = world_cell(worldmap, Rover.pos)
+    sample_cells = [world_cell(worldmap, pos) for pos in Rover.samples_pos_detected[:Rover.samples_located]]
+    Rover.route.collect(rover_cell, sample_cells, Rover.samples_collected)
+    with profiler.stage('decision.route'):
+        route = Rover.route.plan(rover_cell, sample_cells, world_cell(worldmap, Rover.start_pos))
+    explored = Rover.frontiers is not None and worldmap.any(NAVIGABLE) and not Rover.frontiers.cells
+    if route:
+        Rover.goal_pos = Rover.samples_pos_detected[route[0]]
+    elif Rover.samples_to_find > 0 and Rover.samples_collected >= Rover.samples_to_find or explored:
+        Rover.goal_pos = Rover.start_pos
+    else:
+        Rover.goal_pos = None
+    return Rover
+
+# Steer along the planned path towards Rover.goal_pos, keeping the
+# previous steering while the search is unfinished
+def control_path(Rover):
+    worldmap = Rover.worldmap
+    with profiler.stage('decision.path_planning'):
+        found = Rover.path_planner.plan(world_cell(worldmap, Rover.pos), world_cell(worldmap, Rover.goal_pos))
+    if not found:
+        Rover.steer = Rover.prev_steer
+        return Rover
+    xway, yway = Rover.path_planner.waypoint(worldmap.cell_size)
+    Rover.yawref = wrap_angle_180(np.arctan2(yway-Rover.pos[1], xway-Rover.pos[0])*180/np.pi)
+    return control_yaw(Rover)
+
 # Velocity controller
 def control_vel(Rover,refvel):
     error = (refvel - Rover.vel)
-    ctrl_throttle = Rover.Kp_vel*error + Rover.Ki_vel *1/25* Rover.int_error_vel
+    ctrl_throttle = Rover.config.Kp_vel*error + Rover.config.Ki_vel*Rover.int_error_vel
+    # The error is integrated over simulation time, independent of the frame rate
     if abs(ctrl_throttle)<1:
-        Rover.int_error_vel = Rover.int_error_vel + error
+        Rover.int_error_vel = Rover.int_error_vel + error*Rover.frame_dt
 
     Rover.throttle = np.clip(ctrl_throttle,-1,1)
     return Rover
@@ -34,144 +79,210 @@ def check_sticking(Rover):
     # Check for collision
     total_time_stopped = 0
     if abs(Rover.vel)<0.2 and (Rover.time_stopped == 0):
-        Rover.time_stopped = time.time()
+        Rover.time_stopped = Rover.sim_time
     elif abs(Rover.vel)<0.2 and (Rover.time_stopped != 0):
-        total_time_stopped = time.time()-Rover.time_stopped
+        total_time_stopped = Rover.sim_time-Rover.time_stopped
     else:
         Rover.time_stopped = 0
-    if total_time_stopped>Rover.max_time_stopped:
-        print('Rover stuck')
+    if total_time_stopped>Rover.config.max_time_stopped:
         Rover.time_stopped = 0 
-        Rover.yawref = wrap_angle_180(Rover.nyaw - Rover.unstick_angle) 
-        Rover.mode = 'unsticking'
-    return Rover
+        Rover.yawref = wrap_angle_180(Rover.nyaw - Rover.config.unstick_angle) 
+        return True
+    return False
 
 # This function checks if the rover is in a loop
 def check_looping(Rover):
     #Checking for looping
     total_time_looping = 0
-    flag_angle = abs(abs(Rover.steer)-Rover.stuck_steer_angle)<0.5
+    flag_angle = abs(abs(Rover.steer)-Rover.config.stuck_steer_angle)<0.5
     flag_speed = abs(Rover.vel)>0.5
     if flag_angle and flag_speed and (Rover.time_looping == 0):
-        Rover.time_looping = time.time()
+        Rover.time_looping = Rover.sim_time
     elif flag_angle and flag_speed and (Rover.time_looping != 0):
-        total_time_looping = time.time()-Rover.time_looping
+        total_time_looping = Rover.sim_time-Rover.time_looping
     else:
         Rover.time_looping = 0
-    if total_time_looping>Rover.max_time_looping:
-        print('Rover in a loop')
+    if total_time_looping>Rover.config.max_time_looping:
         Rover.time_looping = 0
         if Rover.steer>0:
-            Rover.yawref = wrap_angle_180(Rover.nyaw - Rover.unstick_angle)
+            Rover.yawref = wrap_angle_180(Rover.nyaw - Rover.config.unstick_angle)
         else:
-            Rover.yawref = wrap_angle_180(Rover.nyaw + Rover.unstick_angle)
-        Rover.mode = 'unsticking'
-    return Rover
+            Rover.yawref = wrap_angle_180(Rover.nyaw + Rover.config.unstick_angle)
+        return True
+    return False
+
+
+# Modes of the decision state machine.  A mode handler sets the commands of
+# the current frame and returns the name of the next mode, or None to stay.
+# Handlers keep no state of their own, timers live in Rover and run on
+# simulation time, so a recorded run replays the same transitions.
+class Mode(ABC):
+    name = None
+
+    @abstractmethod
+    def step(self, Rover):
+        pass
+
+# The rover is stuck or looping, turn in place towards Rover.yawref
+class UnstickingMode(Mode):
+    name = 'unsticking'
+
+    def step(self, Rover):
+        Rover.throttle = 0
+        Rover.brake = 0
+        if abs(Rover.nyaw-Rover.yawref)<1:
+            return 'forward'
+        control_yaw(Rover)
+
+# Drive towards the goal, the best frontier or the mean navigable angle
+class ForwardMode(Mode):
+    name = 'forward'
+
+    def step(self, Rover):
+        # If there's a lack of navigable terrain pixels then go to 'stop' mode
+        if Rover.nav.count < Rover.config.stop_forward:
+            # Set mode to "stop" and hit the brakes!
+            Rover.throttle = 0
+            # Set brake to stored brake value
+            Rover.brake = Rover.config.brake_set
+            Rover.steer = 0
+            return 'stop'
+        # If mode is forward, navigable terrain looks good 
+        # and velocity is below max, then throttle 
+        control_vel(Rover, Rover.config.vel_fwd)
+        Rover.brake = 0
+        heading = None
+        if Rover.frontiers is not None:
+            heading = Rover.frontiers.heading(Rover.pos, Rover.nyaw, Rover.worldmap.cell_size)
+        if Rover.goal_pos is not None:
+            # Head for the next sample of the route, or back to the start
+            control_path(Rover)
+            returning = not Rover.route.route
+            if returning and np.hypot(Rover.pos[0]-Rover.start_pos[0],
+                                      Rover.pos[1]-Rover.start_pos[1]) < Rover.config.home_radius:
+                return 'home'
+        elif heading is not None:
+            control_frontier(Rover, heading)
+        else:
+            # Set steering to average angle clipped to the range +/- 15
+            Rover.steer = np.clip(Rover.nav.mean + Rover.config.deviation, -15, 15)
+
+# Drive slowly towards a rock sample in sight and pick it up
+class ApproachingMode(Mode):
+    name = 'approaching'
+
+    def step(self, Rover):
+        if Rover.near_sample != 0:
+            Rover.brake = Rover.config.brake_set
+            Rover.send_pickup = True
+            if Rover.picking_up == 0:
+                return 'forward'
+            return None
+        control_vel(Rover, Rover.config.vel_apch)
+        Rover.brake = 0
+        # Set steering to average angle clipped to the range +/- 15
+        if Rover.sample_in_sight:
+            Rover.time_approaching = 0
+            Rover.steer = np.clip(Rover.rocks.mean, -15, 15)
+            Rover.prev_steer = Rover.steer
+        elif Rover.goal_pos is not None:
+            control_path(Rover)
+        else:
+            Rover.steer = Rover.prev_steer
+        # Give up after losing sight of the sample for max_time_approaching
+        total_time_approaching = 0
+        if Rover.time_approaching == 0:
+            Rover.time_approaching = Rover.sim_time
+        else:
+            total_time_approaching = Rover.sim_time-Rover.time_approaching
+        if total_time_approaching>Rover.config.max_time_approaching:
+            Rover.time_approaching = 0 
+            return 'forward'
+
+# Brake until stopped, then turn in place until there is a way forward
+class StopMode(Mode):
+    name = 'stop'
+
+    def step(self, Rover):
+        # If we're in stop mode but still moving keep braking
+        if Rover.vel > 0.2:
+            Rover.throttle = 0
+            Rover.brake = Rover.config.brake_set
+            Rover.steer = 0
+            Rover.time_stopped = 0
+        # Now we're stopped and we have vision data to see if there's a path forward
+        elif Rover.nav.count < Rover.config.go_forward:
+            Rover.throttle = 0
+            # Release the brake to allow turning
+            Rover.brake = 0
+            # Turn range is +/- 15 degrees, when stopped the next line will induce 4-wheel turning
+            # Turn towards the side with more free space in sight, right on a tie
+            left, right = Rover.nav.sides()
+            Rover.steer = 15 if left > right else -15
+        # If we're stopped but see sufficient navigable terrain in front then go!
+        else:
+            # Set throttle back to stored value
+            Rover.throttle = Rover.config.throttle_set
+            # Release the brake
+            Rover.brake = 0
+            # Set steer to mean angle
+            Rover.steer = np.clip(Rover.nav.mean, -15, 15)
+            return 'forward'
+
+# Back at the start position, the mission is over
+class HomeMode(Mode):
+    name = 'home'
+
+    def step(self, Rover):
+        Rover.throttle = 0
+        Rover.brake = Rover.config.brake_set
+        Rover.steer = 0
+
+# Dispatch table of the mode handlers
+MODES = {mode.name: mode for mode in (UnstickingMode(), ForwardMode(), ApproachingMode(),
+                                      StopMode(), HomeMode())}
+
+# Switch mode, accounting the simulation time spent in the previous one
+def transition(Rover, mode):
+    if mode == Rover.mode:
+        return
+    logger.info('%.2f s: %s -> %s', Rover.sim_time, Rover.mode, mode)
+    Rover.transitions.append((Rover.sim_time, Rover.mode, mode))
+    Rover.mode = mode
+    Rover.mode_start = Rover.sim_time
+
+# Transitions that apply whatever the current mode
+def global_transition(Rover):
+    if Rover.mode in ('unsticking', 'home') or Rover.picking_up != 0:
+        return None
+    mode = 'approaching' if Rover.sample_in_sight else None
+    # Both checks update their timers every frame
+    stuck = check_sticking(Rover)
+    looping = check_looping(Rover)
+    if stuck or looping:
+        mode = 'unsticking'
+    return mode
+
 # This is where you can build a decision tree for determining throttle, brake and steer 
 # commands based on the output of the perception_step() function
 def decision_step(Rover):
-    global flag_print
-    # Implement conditionals to decide what to do given perception data
-    # Here you're all set up with some basic functionality but you'll need to
-    # improve on this decision tree to do a good job of navigating autonomously!
-    
-    # Example:
     # Check if we have vision data to make decisions with
-    if Rover.nav_angles is not None:
-        if Rover.flag_print:
-            print(Rover.mode)
-        # Check for Rover.mode status
-        # Check for sticking and looping if not unsticking
-        if Rover.mode != 'unsticking' and Rover.picking_up == 0:
-            if Rover.sample_in_sight:
-                Rover.mode = 'approaching'
-            Rover = check_sticking(Rover)
-            Rover = check_looping(Rover)
-        # Check for Rover.mode status
-        #print(Rover.mode)
-        if Rover.mode == 'unsticking':
-            # The rover is stuck
-            Rover.throttle = 0
-            Rover.brake = 0
-            if abs(Rover.nyaw-Rover.yawref)<1:
-                Rover.mode = 'forward'
-            else:
-                Rover = control_yaw(Rover)
-
-        elif Rover.mode == 'forward':
-            # Check the extent of navigable terrain
-            if len(Rover.nav_angles) >= Rover.stop_forward:  
-                # If mode is forward, navigable terrain looks good 
-                # and velocity is below max, then throttle 
-                Rover = control_vel(Rover, Rover.vel_fwd)
-                Rover.brake = 0
-                # Set steering to average angle clipped to the range +/- 15
-                nav_angle = np.mean(Rover.nav_angles* 180/np.pi)
-                Rover.steer = np.clip(nav_angle + Rover.deviation, -15, 15)
-            # If there's a lack of navigable terrain pixels then go to 'stop' mode
-            elif len(Rover.nav_angles) < Rover.stop_forward:
-                    # Set mode to "stop" and hit the brakes!
-                    Rover.throttle = 0
-                    # Set brake to stored brake value
-                    Rover.brake = Rover.brake_set
-                    Rover.steer = 0
-                    Rover.mode = 'stop'
-        elif Rover.mode == 'approaching':
-            if Rover.near_sample == 0:
-                Rover = control_vel(Rover, Rover.vel_apch)
-                Rover.brake = 0
-                # Set steering to average angle clipped to the range +/- 15
-                if Rover.sample_in_sight:
-                    Rover.time_approaching = 0
-                    nav_angle = np.mean(Rover.rocks_angles* 180/np.pi)
-                    Rover.steer = np.clip(nav_angle, -15, 15)
-                    Rover.prev_steer = Rover.steer
-                else:
-                    Rover.steer = Rover.prev_steer
-                # Stay in this mode at least one second
-                total_time_approaching = 0
-                if Rover.time_approaching == 0:
-                    Rover.time_approaching = time.time()
-                else:
-                    total_time_approaching = time.time()-Rover.time_approaching
-                if total_time_approaching>Rover.max_time_approaching:
-                    Rover.time_approaching = 0 
-                    Rover.mode = 'forward'
-            else:
-                Rover.brake = Rover.brake_set
-                Rover.send_pickup = True
-                if Rover.picking_up == 0:
-                    Rover.mode = 'forward'
-        # If we're already in "stop" mode then make different decisions
-        elif Rover.mode == 'stop':
-            # If we're in stop mode but still moving keep braking
-            if Rover.vel > 0.2:
-                Rover.throttle = 0
-                Rover.brake = Rover.brake_set
-                Rover.steer = 0
-                Rover.time_stopped = 0
-            # If we're not moving (vel < 0.2) then do something else
-            elif Rover.vel <= 0.2:
-                # Now we're stopped and we have vision data to see if there's a path forward
-                if len(Rover.nav_angles) < Rover.go_forward:
-                    Rover.throttle = 0
-                    # Release the brake to allow turning
-                    Rover.brake = 0
-                    # Turn range is +/- 15 degrees, when stopped the next line will induce 4-wheel turning
-                    Rover.steer = -15 # Could be more clever here about which way to turn
-                # If we're stopped but see sufficient navigable terrain in front then go!
-                if len(Rover.nav_angles) >= Rover.go_forward:
-                    # Set throttle back to stored value
-                    Rover.throttle = Rover.throttle_set
-                    # Release the brake
-                    Rover.brake = 0
-                    # Set steer to mean angle
-                    Rover.steer = np.clip(np.mean(Rover.nav_angles * 180/np.pi), -15, 15)
-                    Rover.mode = 'forward'
+    if Rover.nav is not None:
+        if Rover.mode_start is None:
+            Rover.mode_start = Rover.sim_time
+        Rover.mode_dwell[Rover.mode] = Rover.mode_dwell.get(Rover.mode, 0) + Rover.frame_dt
+        Rover = update_route(Rover)
+        mode = global_transition(Rover)
+        if mode is not None:
+            transition(Rover, mode)
+        with profiler.stage('mode.' + Rover.mode):
+            mode = MODES[Rover.mode].step(Rover)
+        if mode is not None:
+            transition(Rover, mode)
     # Just to make the rover do something 
     # even if no modifications have been made to the code
     else:
-        Rover.throttle = Rover.throttle_set
+        Rover.throttle = Rover.config.throttle_set
         Rover.steer = 0
         Rover.brake = 0
         
@@ -179,4 +290,4 @@ def decision_step(Rover):
     if Rover.near_sample and Rover.vel == 0 and not Rover.picking_up:
         Rover.send_pickup = True
     
-    return Rover
\ No newline at end of file
+    return Rover
@@ -14,186 +14,230 @@ from flask import Flask
 from io import BytesIO, StringIO
 import json
 import pickle
-import matplotlib.image as mpimg
 import time
+import logging
+from collections import deque
+import eventlet.tpool
 
 # Import functions for perception and decision making
-from perception import perception_step
-from decision import decision_step
-from supporting_functions import update_rover, create_output_images
+from inset_encoder import InsetEncoder
+from rover_state import RoverState, RoverConfig
+from telemetry_log import TelemetryRecorder
+from profiling import profiler
+from pipeline import PipelinedDriver
+from run_store import RunWriter, telemetry_record
+from session_pool import SessionPool, step_rover
+from perception import classifier
 # Initialize socketio server and Flask application 
 # (learn more at: https://python-socketio.readthedocs.io/en/latest/)
 sio = socketio.Server()
+logger = logging.getLogger('rover')
 app = Flask(__name__)
 
-# Read in ground truth map and create 3-channel green version for overplotting
-# NOTE: images are read in by default with the origin (0, 0) in the upper left
-# and y-axis increasing downward.
-ground_truth = mpimg.imread('../calibration_images/map_bw.png')
-# This next line creates arrays of zeros in the red and blue channels
-# and puts the map into the green channel.  This is why the underlying 
-# map output looks green in the display image
-ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(np.float)
-
-# Define RoverState() class to retain rover state parameters
-class RoverState():
-    def __init__(self):
-        self.start_time = None # To record the start time of navigation
-        self.total_time = None # To record total duration of naviagation
-        # Intial times
-        self.time_stopped = 0 # Time stoped in foward mode
-        self.time_looping = 0 # Time looping in foward mode
-        self.time_approaching = 0 # Time blocking approaching
-        # Maximum times
-        self.max_time_stopped = 1 # Maximum stopped time in seconds
-        self.max_time_looping = 5 # Maximum looping time in seconds
-        self.max_time_approaching = 0.5 # Maximum approaching time in seconds
-        self.img = None # Current camera image
-        self.pos = None # Current position (x, y)
-        self.yaw = None # Current yaw angle
-        self.pitch = None # Current pitch angle
-        self.roll = None # Current roll angle
-        self.max_roll = 2 # Maximum roll angle to consider valid mapping data
-        self.max_pitch = 2 # Maximum pitch angle to consider valid mapping data
-        self.vel = None # Current velocity
-        self.steer = 0 # Current steering angle
-        self.throttle = 0 # Current throttle value
-        self.brake = 0 # Current brake value
-        self.nav_angles = None # Angles of navigable terrain pixels
-        self.nav_dists = None # Distances of navigable terrain pixels
-        self.ground_truth = ground_truth_3d # Ground truth worldmap
-        self.brake_set = 10 # Brake setting when braking
-        # The stop_forward and go_forward fields below represent total count
-        # of navigable terrain pixels.  This is a very crude form of knowing
-        # when you can keep going and when you should stop.  Feel free to
-        # get creative in adding new fields or modifying these!
-        self.stop_forward = 50 # Threshold to initiate stopping
-        self.go_forward = 500 # Threshold to go forward again
-        self.max_vel = 2.5 # Maximum velocity (meters/second)
-        # Image output from perception step
-        # Update this image to display your intermediate analysis steps
-        # on screen in autonomous mode
-        self.vision_image = np.zeros((160, 320, 3), dtype=np.float) 
-        # Worldmap
-        # Update this image with the positions of navigable terrain
-        # obstacles and rock samples
-        self.worldmap = np.zeros((200, 200, 3), dtype=np.float) 
-        # Samples
-        self.rocks_angles = None # Angles of rock samples pixels
-        self.samples_pos = None # To store the actual sample positions
-        self.samples_pos_detected = np.zeros((6, 2), dtype=np.float) # To store detected samples
-        self.samples_to_find = 0 # To store the initial count of samples
-        self.samples_located = 0 # To store number of samples located on map
-        self.prev_samples_located = 0
-        self.samples_collected = 0 # To count the number of samples collected
-        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
-        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
-        self.send_pickup = False # Set to True to trigger rock pickup
-        self.flag_print = 0 # Flag to print values at a certain rate
-        
-        # Modes parameters
-        self.mode = 'forward' # Current mode (can be forward or stop)
-        # Forward
-        self.throttle_set = 0.5 # Throttle setting when accelerating
-        self.deviation = 8 # Deviation from navigable angle
-        self.vel_fwd = 3 # Velocity in forward mode [m/s]
-        # Unsticking
-        self.unstick_angle = 25 # Angle to turn when unsticking
-        self.stuck_steer_angle = 15 # Angle to detect looping
-        # Approaching
-        self.sample_in_sight = False # Flag to check if there is a sample rock in sight
-        self.vel_apch = 0.5 # Velocity in approaching mode [m/s]
-        self.throttle_apch = 0.2 # Throttle value when approaching to a sample rock
-        self.prev_steer = 0 # Previous steer angle
-        # Yaw controller
-        self.yawref = 0 # Yaw reference angle
-        self.Kp_yaw = 0.5 # Yaw controller proportional gain
-        # Velocity controller
-        self.Kp_vel = 0.7 # Velocity controller proportional gain 
-        self.Ki_vel = 0.08 # Velocity controller integral gain
-        self.int_error_vel = 0 # Velocity controller integral term
-# Initialize our rover 
-Rover = RoverState()
-
-# Variables to track frames per second (FPS)
-# Intitialize frame counter
-frame_counter = 0
-# Initalize second counter
-second_counter = time.time()
-fps = None
+# Tuning of the rovers, set from the command line
+config = RoverConfig()
+# Sessions of the connected simulators, by socket id
+sessions = {}
+# Number of sessions opened so far
+session_count = 0
+# Worker processes running the rovers, set with --workers
+session_pool = None
 
 
+# Path of the recording of a session: the given path for the first
+# simulator, then numbered paths next to it
+def session_path(path, index):
+    if path == '' or index == 0:
+        return path
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, index, ext)
+
+# Everything one simulator connection needs: its rover, FPS and latency
+# counters, recorders and optional pipeline.  With --workers the rover
+# lives on a worker process of the session pool instead.
+class RoverSession():
+    def __init__(self, sid, index):
+        self.sid = sid
+        self.index = index # Order of connection, 0 for the first simulator
+        self.Rover = None
+        self.inset_encoder = None
+        if session_pool is None:
+            self.Rover = RoverState(config)
+            self.inset_encoder = InsetEncoder(args.inset_rate)
+        # Variables to track frames per second (FPS)
+        self.frame_counter = 0
+        self.second_counter = time.time()
+        self.fps = None
+        # Decoding time accumulated over the current second
+        self.decode_time_sum = 0
+        # Seconds from receiving a frame to sending its command
+        self.latencies = deque(maxlen=1024)
+        # Telemetry log writer, set when the run is recorded with --record
+        self.recorder = None
+        if args.record != '':
+            self.recorder = TelemetryRecorder(session_path(args.record, index))
+        # Camera frame recording, one JPEG per frame or a memory-mapped run
+        self.image_folder = session_path(args.image_folder, index)
+        self.run_writer = None
+        if self.image_folder != '':
+            os.makedirs(self.image_folder, exist_ok=True)
+            if args.record_format == 'memmap':
+                self.run_writer = RunWriter(self.image_folder)
+        # Worker running the frame processing, set in --pipeline mode
+        self.pipeline = PipelinedDriver(self.process_frame) if args.pipeline else None
+
+    # Run one telemetry frame through the pipeline and decide what to send back.
+    # Returns the (throttle, brake, steer) commands, whether to send the pickup
+    # command instead, and the inset image strings.
+    def process_frame(self, data):
+        if session_pool is not None:
+            future = session_pool.submit(self.sid, data)
+            # Wait on a native thread so that the other sessions keep being served,
+            # the pipeline already runs on its own thread
+            if self.pipeline is None:
+                commands, pickup, out_images, decode_time, _, records = eventlet.tpool.execute(future.result)
+            else:
+                commands, pickup, out_images, decode_time, _, records = future.result()
+            # Stages timed on the worker process, traced under its worker index
+            profiler.merge(records, pid=session_pool.assigned.get(self.sid, 0) + 1)
+            self.decode_time_sum += decode_time
+            return commands, pickup, out_images
+
+        self.Rover, jpeg, commands, pickup, out_images = step_rover(self.Rover, self.inset_encoder, data)
+        Rover = self.Rover
+        self.decode_time_sum += Rover.decode_time
+
+        # If you want to save camera images from autonomous driving specify a path
+        # Example: $ python drive_rover.py image_folder_path
+        # With --record_format memmap the frame goes to the run files with its telemetry
+        if self.run_writer is not None:
+            if 'samples_x' not in self.run_writer.meta and Rover.samples_pos is not None:
+                self.run_writer.update_meta(samples_x=Rover.samples_pos[0].tolist(),
+                                            samples_y=Rover.samples_pos[1].tolist())
+            self.run_writer.append(Rover.img, telemetry_record(Rover, commands, pickup))
+        # Conditional to save image frame if folder was specified
+        elif self.image_folder != '':
+            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
+            image_filename = os.path.join(self.image_folder, timestamp)
+            # The frame is already JPEG encoded, write it as it is
+            with open('{}.jpg'.format(image_filename), 'wb') as image_file:
+                image_file.write(jpeg)
+        return commands, pickup, out_images
+
+    # Log the throughput and latency of the session over the last second
+    def report(self):
+        self.fps = self.frame_counter
+        latency_p50, latency_p95 = 1000*np.percentile(self.latencies, [50, 95]) if self.latencies else (0, 0)
+        logger.info("[%s] Current FPS: %s, mean decode time: %.2f ms, latency p50 %.1f ms p95 %.1f ms",
+                    self.sid, self.fps, 1000*self.decode_time_sum/max(self.frame_counter, 1),
+                    latency_p50, latency_p95)
+        if self.pipeline is not None:
+            logger.info("[%(sid)s] Pipeline: %(received)d received, %(processed)d processed, %(failed)d failed, "
+                        "%(dropped)d dropped, latency p50 %(latency_p50).1f ms p95 %(latency_p95).1f ms",
+                        dict(self.pipeline.stats(), sid=self.sid))
+        Rover = self.Rover
+        if Rover is not None and Rover.total_time:
+            logger.info("[%s] Mapped: %s%%, %.1f%% per minute", self.sid, Rover.map_metrics.perc_mapped(),
+                        60*Rover.map_metrics.perc_mapped()/Rover.total_time)
+        if Rover is not None and Rover.path_planner.goal is not None:
+            logger.info("[%s] Path planner: %d expansions, %.2f ms", self.sid, Rover.path_planner.expansions,
+                        1000*Rover.path_planner.plan_time)
+        self.frame_counter = 0
+        self.decode_time_sum = 0
+        self.second_counter = time.time()
+
+    def close(self):
+        if self.pipeline is not None:
+            self.pipeline.stop()
+        if self.inset_encoder is not None:
+            self.inset_encoder.shutdown()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.run_writer is not None:
+            self.run_writer.close()
+        if session_pool is not None:
+            session_pool.close(self.sid)
+
+def open_session(sid):
+    global session_count
+    session = sessions.get(sid)
+    if session is None:
+        session = sessions[sid] = RoverSession(sid, session_count)
+        session_count += 1
+    return session
+
+def close_session(sid):
+    session = sessions.pop(sid, None)
+    if session is not None:
+        session.close()
+
 # Define telemetry function for what to do with incoming data
 @sio.on('telemetry')
 def telemetry(sid, data):
-
-    global frame_counter, second_counter, fps, Rover
-    frame_counter+=1
+    received = time.perf_counter()
+    session = open_session(sid)
+    session.frame_counter+=1
     # Do a rough calculation of frames per second (FPS)
-    Rover.flag_print = (time.time() - second_counter) > 1
-    if (time.time() - second_counter) > 1:
-        fps = frame_counter
-        frame_counter = 0
-        second_counter = time.time()
-    print("Current FPS: {}".format(fps))
+    if (time.time() - session.second_counter) > 1:
+        session.report()
 
     if data:
-        # Initialize / update Rover with current telemetry
-        Rover, image = update_rover(Rover, data)
-
-        if np.isfinite(Rover.vel):
+        # Stamp frames with their receive time when the simulator does not
+        # send its own clock, before recording so that replays see the same time
+        if 'time' not in data:
+            data['time'] = repr(time.time())
+        # Log the raw telemetry if this run is being recorded
+        if session.recorder is not None:
+            session.recorder.write_telemetry(data)
 
-            # Execute the perception and decision steps to update the Rover's state
-            Rover = perception_step(Rover)
-            Rover = decision_step(Rover)
-
-            # Create output images to send to server
-            out_image_string1, out_image_string2 = create_output_images(Rover)
+        if session.pipeline is None:
+            commands, pickup, out_images = session.process_frame(data)
+        else:
+            # Hand the frame to the worker and answer with the latest decision
+            session.pipeline.submit(data)
+            result, new_result = session.pipeline.latest()
+            if result is None:
+                commands, pickup, out_images = (0, 0, 0), False, ('', '')
+            else:
+                # A pickup is only sent once, the controls are repeated until
+                # a newer frame has been processed
+                commands, out_images = result.commands, result.images
+                pickup = result.pickup and new_result
 
-            # The action step!  Send commands to the rover!
+        # The action step!  Send commands to the rover!
  
-            # Don't send both of these, they both trigger the simulator
-            # to send back new telemetry so we must only send one
-            # back in respose to the current telemetry data.
-
-            # If in a state where want to pickup a rock send pickup command
-            if Rover.send_pickup and not Rover.picking_up:
-                send_pickup()
-                # Reset Rover flags
-                Rover.send_pickup = False
+        # Don't send both of these, they both trigger the simulator
+        # to send back new telemetry so we must only send one
+        # back in respose to the current telemetry data.
+        with profiler.stage('command'):
+            if pickup:
+                send_pickup(session)
             else:
                 # Send commands to the rover!
-                commands = (Rover.throttle, Rover.brake, Rover.steer)
-                send_control(commands, out_image_string1, out_image_string2)
-
-        # In case of invalid telemetry, send null commands
-        else:
-            print('Data is not received')
-            # Send zeros for throttle, brake and steer and empty images
-            send_control((0, 0, 0), '', '')
-
-        # If you want to save camera images from autonomous driving specify a path
-        # Example: $ python drive_rover.py image_folder_path
-        # Conditional to save image frame if folder was specified
-        if args.image_folder != '':
-            timestamp = datetime.utcnow().strftime('%Y_%m_%d_%H_%M_%S_%f')[:-3]
-            image_filename = os.path.join(args.image_folder, timestamp)
-            image.save('{}.jpg'.format(image_filename))
+                send_control(session, commands, out_images[0], out_images[1])
+        session.latencies.append(time.perf_counter() - received)
+        profiler.maybe_report()
 
     else:
-        sio.emit('manual', data={}, skip_sid=True)
+        sio.emit('manual', data={}, to=sid)
 
 @sio.on('connect')
 def connect(sid, environ):
     print("connect ", sid)
-    send_control((0, 0, 0), '', '')
+    session = open_session(sid)
+    send_control(session, (0, 0, 0), '', '')
     sample_data = {}
     sio.emit(
         "get_samples",
         sample_data,
-        skip_sid=True)
+        to=sid)
 
-def send_control(commands, image_string1, image_string2):
+@sio.on('disconnect')
+def disconnect(sid, *reason):
+    print("disconnect ", sid)
+    close_session(sid)
+
+def send_control(session, commands, image_string1, image_string2):
     # Define commands to be sent to the rover
     data={
         'throttle': commands[0].__str__(),
@@ -202,20 +246,24 @@ def send_control(commands, image_string1, image_string2):
         'inset_image1': image_string1,
         'inset_image2': image_string2,
         }
-    # Send commands via socketIO server
+    # Send commands via socketIO server, to this simulator only
     sio.emit(
         "data",
         data,
-        skip_sid=True)
+        to=session.sid)
+    if session.recorder is not None:
+        session.recorder.write_control(commands)
     eventlet.sleep(0)
 # Define a function to send the "pickup" command 
-def send_pickup():
+def send_pickup(session):
     print("Picking up")
     pickup = {}
     sio.emit(
         "pickup",
         pickup,
-        skip_sid=True)
+        to=session.sid)
+    if session.recorder is not None:
+        session.recorder.write_pickup()
     eventlet.sleep(0)
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Remote Driving')
@@ -226,7 +274,109 @@ if __name__ == '__main__':
         default='',
         help='Path to image folder. This is where the images from the run will be saved.'
     )
+    parser.add_argument(
+        '--inset_rate',
+        type=float,
+        default=5,
+        help='Maximum rate (Hz) at which the map and vision insets are rendered, 0 for every frame.'
+    )
+    parser.add_argument(
+        '--log_level',
+        type=str,
+        default='INFO',
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+        help='Logging level, DEBUG prints the full rover status on every frame.'
+    )
+    parser.add_argument(
+        '--record',
+        type=str,
+        default='',
+        help='Path of a telemetry log recording every frame and command, for replay.py.'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Time every pipeline stage and log latency percentiles periodically.'
+    )
+    parser.add_argument(
+        '--trace',
+        type=str,
+        default='',
+        help='Path of a Chrome trace (JSON) of the profiled stages, written on exit. Implies --profile.'
+    )
+    parser.add_argument(
+        '--pipeline',
+        action='store_true',
+        help='Process frames on a worker thread, answering each frame with the latest decision and dropping stale frames.'
+    )
+    parser.add_argument(
+        '--record_format',
+        type=str,
+        default='jpeg',
+        choices=['jpeg', 'memmap'],
+        help='Format of the image_folder recording: one JPEG per frame, or memory-mapped frame and telemetry chunks.'
+    )
+    parser.add_argument(
+        '--map_backend',
+        type=str,
+        default='dense',
+        choices=['dense', 'tiled'],
+        help='Worldmap storage: a fixed 200 x 200 m grid, or sparse tiles allocated as the rover explores.'
+    )
+    parser.add_argument(
+        '--map_resolution',
+        type=float,
+        default=1.0,
+        help='Cell size in meters of the tiled worldmap.'
+    )
+    parser.add_argument(
+        '--map_extent',
+        type=float,
+        nargs=4,
+        default=[0, 0, 200, 200],
+        metavar=('X', 'Y', 'WIDTH', 'HEIGHT'),
+        help='Area in meters covered by the tiled worldmap and searched by the path planner.'
+    )
+    parser.add_argument(
+        '--planner',
+        type=str,
+        default='frontier',
+        choices=['frontier', 'reactive'],
+        help='Exploration: head for the cheapest frontier of the worldmap, or follow the mean navigable angle.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=0,
+        help='Worker processes running the rovers of the connected simulators, 0 to run them in this process.'
+    )
+    parser.add_argument(
+        '--perception',
+        type=str,
+        default='full',
+        choices=['full', 'roi', 'adaptive'],
+        help='Process the whole camera frame, only the mapped rows plus a sampled view, or sample at a step fitting --frame_budget.'
+    )
+    parser.add_argument(
+        '--frame_budget',
+        type=float,
+        default=5,
+        help='Perception time budget per frame (ms) of --perception adaptive.'
+    )
     args = parser.parse_args()
+    if args.workers > 0 and args.image_folder != '':
+        parser.error('camera frames cannot be recorded to image_folder with --workers')
+    if args.map_backend == 'dense' and args.map_extent != [0, 0, 200, 200]:
+        parser.error('--map_extent requires --map_backend tiled')
+    config = RoverConfig(map_backend=args.map_backend, map_resolution=args.map_resolution,
+                         map_extent=tuple(args.map_extent),
+                         planner=args.planner, perception_mode=args.perception,
+                         frame_budget=args.frame_budget/1000)
+    if args.profile or args.trace != '':
+        profiler.enable(trace=args.trace != '')
+    logging.basicConfig(level=args.log_level, format='%(message)s')
+    # Build the RGB label table before the first frame, and before forking workers
+    classifier.table()
     
     #os.system('rm -rf IMG_stream/*')
     if args.image_folder != '':
@@ -239,9 +389,24 @@ if __name__ == '__main__':
         print("Recording this run ...")
     else:
         print("NOT recording this run ...")
+    if args.record != '':
+        print("Logging telemetry to {}".format(args.record))
+    if args.pipeline:
+        print("Running in pipelined mode")
+    if args.workers > 0:
+        print("Running the rovers on {} worker processes".format(args.workers))
+        session_pool = SessionPool(args.workers, config, args.inset_rate, profile=profiler.enabled)
     
     # wrap Flask application with socketio's middleware
     app = socketio.Middleware(sio, app)
 
     # deploy as an eventlet WSGI server
-    eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
\ No newline at end of file
+    try:
+        eventlet.wsgi.server(eventlet.listen(('', 4567)), app)
+    finally:
+        for sid in list(sessions):
+            close_session(sid)
+        if session_pool is not None:
+            session_pool.shutdown()
+        if args.trace != '':
+            profiler.dump_trace(args.trace)
@@ -0,0 +1,89 @@
+import numpy as np
+
+from occupancy_grid import OBSTACLE, NAVIGABLE
+from supporting_functions import wrap_angle_180
+
+# 4-connected neighbourhood of a cell
+NEIGHBOURS = ((1, 0), (-1, 0), (0, 1), (0, -1))
+
+
+# Frontier-based exploration over the worldmap.  A frontier cell is a cell
+# mapped as navigable with at least one unknown neighbour.  The frontier set
+# is updated incrementally: only the cells hit this frame and their
+# neighbours can change status, so nothing else is revisited.  Frontier
+# cells are grouped into square clusters with running centroids, and the
+# target is the cluster with the lowest travel cost.
+class FrontierPlanner():
+    def __init__(self, cluster_size=5, min_cluster=4, min_dist=3, turn_weight=10, gain_weight=0.5):
+        self.cluster_size = cluster_size # Cluster side in meters
+        self.min_cluster = min_cluster # Frontier cells for a cluster to be a target
+        self.min_dist = min_dist # Clusters closer than this (meters) are being mapped already
+        self.turn_weight = turn_weight # Cost in meters of turning around
+        self.gain_weight = gain_weight # Cost reduction in meters per frontier cell of a cluster
+        self.cells = {} # (x, y) frontier cell -> cluster key
+        self.clusters = {} # (cluster x, cluster y) -> [cells, sum of x, sum of y]
+        self.target = None # (x, y) in meters of the selected cluster centroid
+
+    # Known cells have been hit in the navigable or obstacle layer, navigable
+    # cells have at least as many navigable as obstacle hits
+    @staticmethod
+    def known(worldmap, xcell, ycell):
+        return (worldmap.values(NAVIGABLE, ycell, xcell) > 0) | (worldmap.values(OBSTACLE, ycell, xcell) > 0)
+
+    @staticmethod
+    def navigable(worldmap, xcell, ycell):
+        nav = worldmap.values(NAVIGABLE, ycell, xcell)
+        return (nav > 0) & (nav >= worldmap.values(OBSTACLE, ycell, xcell))
+
+    # Re-evaluate the cells hit this frame and their neighbours
+    def update(self, worldmap, xcell, ycell):
+        if len(xcell) == 0:
+            return
+        hit = np.unique(np.stack((xcell, ycell), axis=1).astype(np.int64), axis=0)
+        candidates = np.unique(np.concatenate([hit] + [hit + offset for offset in NEIGHBOURS]), axis=0)
+        xcand, ycand = candidates[:,0], candidates[:,1]
+        unknown_neighbour = np.zeros(len(candidates), dtype=bool)
+        for dx, dy in NEIGHBOURS:
+            unknown_neighbour |= ~self.known(worldmap, xcand + dx, ycand + dy)
+        frontier = self.navigable(worldmap, xcand, ycand) & unknown_neighbour
+        side = max(int(round(self.cluster_size / worldmap.cell_size)), 1)
+        for x, y, is_frontier in zip(xcand.tolist(), ycand.tolist(), frontier.tolist()):
+            cell = (x, y)
+            if is_frontier and cell not in self.cells:
+                key = (x // side, y // side)
+                self.cells[cell] = key
+                cluster = self.clusters.setdefault(key, [0, 0, 0])
+                cluster[0] += 1
+                cluster[1] += x
+                cluster[2] += y
+            elif not is_frontier and cell in self.cells:
+                key = self.cells.pop(cell)
+                cluster = self.clusters[key]
+                cluster[0] -= 1
+                cluster[1] -= x
+                cluster[2] -= y
+                if cluster[0] == 0:
+                    del self.clusters[key]
+
+    # Select the cheapest frontier cluster from the rover pose and return the
+    # heading (degrees) towards it, None when there is nothing left to explore
+    def heading(self, pos, yaw, cell_size=1.0):
+        best_cost = np.inf
+        self.target = None
+        for count, sum_x, sum_y in self.clusters.values():
+            if count < self.min_cluster:
+                continue
+            # Centroid in meters, cell centers are at cell + 0.5
+            x = (sum_x / count + 0.5)*cell_size
+            y = (sum_y / count + 0.5)*cell_size
+            dist = np.hypot(x - pos[0], y - pos[1])
+            if dist < self.min_dist:
+                continue
+            turn = abs(wrap_angle_180(np.arctan2(y - pos[1], x - pos[0])*180/np.pi - yaw)) / 180
+            cost = dist + self.turn_weight*turn - self.gain_weight*count
+            if cost < best_cost:
+                best_cost = cost
+                self.target = (x, y)
+        if self.target is None:
+            return None
+        return wrap_angle_180(np.arctan2(self.target[1] - pos[1], self.target[0] - pos[0])*180/np.pi)
@@ -0,0 +1,47 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from supporting_functions import snapshot_output_data, render_output_images
+from profiling import profiler
+
+
+# Render and JPEG encode the inset images on a worker thread so that the
+# telemetry handler can send its commands without waiting for compression.
+# At most one render is in flight: snapshots taken while the worker is busy
+# are dropped, and the handler always sends the latest finished insets.
+class InsetEncoder():
+    def __init__(self, rate=5):
+        self.period = 1/rate if rate > 0 else 0 # Minimum time between renders in seconds
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None # Render currently running on the worker
+        self.last_submit = None # Time the last snapshot was submitted
+        self.latest = ('', '') # Most recent finished insets
+        self.rendered = 0 # Number of insets rendered
+        self.dropped = 0 # Number of snapshots skipped because the worker was busy
+
+    # Latest finished insets, never blocks
+    def images(self):
+        if self.pending is not None and self.pending.done():
+            self.latest = self.pending.result()
+            self.pending = None
+            self.rendered += 1
+        return self.latest
+
+    # Submit a new snapshot if one is due and the worker is free
+    def update(self, Rover):
+        now = time.monotonic()
+        if self.last_submit is not None and now - self.last_submit < self.period:
+            return
+        self.images()
+        if self.pending is not None:
+            self.dropped += 1
+            return
+        self.last_submit = now
+        self.pending = self.executor.submit(self.render, snapshot_output_data(Rover))
+
+    def render(self, snapshot):
+        with profiler.stage('output.render'):
+            return render_output_images(snapshot)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,123 @@
+# Fuse the rover-frame pixels of many frames into a world map at once
+# Example: $ python map_fusion.py run.rlog --splat bilinear
+import argparse
+import time
+import numpy as np
+
+from occupancy_grid import OBSTACLE, ROCK, NAVIGABLE
+
+
+# Rotate, scale and translate rover-frame pixels of many frames with one
+# batched rotation. frame holds the frame index of every pixel, the poses
+# are per-frame arrays. Returns float world coordinates.
+def batch_rover_to_world(xpix, ypix, frame, xpos, ypos, yaw, scale):
+    yaw_rad = np.asarray(yaw, dtype=np.float64)[frame] * np.pi / 180
+    cos_yaw = np.cos(yaw_rad)
+    sin_yaw = np.sin(yaw_rad)
+    xpix_rot = (xpix * cos_yaw) - (ypix * sin_yaw)
+    ypix_rot = (xpix * sin_yaw) + (ypix * cos_yaw)
+    xpix_tran = (xpix_rot / scale) + np.asarray(xpos, dtype=np.float64)[frame]
+    ypix_tran = (ypix_rot / scale) + np.asarray(ypos, dtype=np.float64)[frame]
+    return xpix_tran, ypix_tran
+
+# Per-frame confidence from the attitude: 1 when level, falling linearly
+# to 0 at the pitch/roll limits used to accept mapping data
+def pose_weights(pitch, roll, max_pitch=2, max_roll=2):
+    tilt = np.maximum(np.abs(np.asarray(pitch, dtype=np.float64))/max_pitch,
+                      np.abs(np.asarray(roll, dtype=np.float64))/max_roll)
+    return np.clip(1 - tilt, 0, 1)
+
+
+# Accumulates weighted hits per map layer.  Nearest splatting bins each
+# pixel into the cell containing it; bilinear splatting spreads it over the
+# four closest cell centers, keeping sub-cell accuracy.  Pixels falling off
+# the map are dropped rather than piled onto the border cells.
+class MapFusion():
+    def __init__(self, rows=200, cols=200, layers=3, scale=10, splat='nearest'):
+        self.rows = rows
+        self.cols = cols
+        self.scale = scale # Pixels per map cell
+        self.splat = splat # 'nearest' or 'bilinear'
+        self.confidence = np.zeros((layers, rows*cols), dtype=np.float64) # Accumulated weight per cell
+
+    # Fuse the rover-frame pixels (xpix, ypix) of the frames given by frame.
+    # weights is an optional per-frame confidence.
+    def fuse(self, layer, xpix, ypix, frame, xpos, ypos, yaw, weights=None):
+        if len(xpix) == 0:
+            return
+        x_world, y_world = batch_rover_to_world(xpix, ypix, frame, xpos, ypos, yaw, self.scale)
+        pixel_weights = None if weights is None else np.asarray(weights, dtype=np.float64)[frame]
+        if self.splat == 'bilinear':
+            self.splat_bilinear(layer, x_world, y_world, pixel_weights)
+        else:
+            self.splat_nearest(layer, x_world, y_world, pixel_weights)
+
+    def splat_nearest(self, layer, x_world, y_world, pixel_weights):
+        x_cell = np.floor(x_world).astype(np.int64)
+        y_cell = np.floor(y_world).astype(np.int64)
+        inside = (x_cell >= 0) & (x_cell < self.cols) & (y_cell >= 0) & (y_cell < self.rows)
+        if pixel_weights is not None:
+            pixel_weights = pixel_weights[inside]
+        self.confidence[layer] += np.bincount(y_cell[inside]*self.cols + x_cell[inside], weights=pixel_weights,
+                                              minlength=self.rows*self.cols)
+
+    def splat_bilinear(self, layer, x_world, y_world, pixel_weights):
+        # Cell i has its center at i + 0.5
+        u = x_world - 0.5
+        v = y_world - 0.5
+        x0 = np.floor(u).astype(np.int64)
+        y0 = np.floor(v).astype(np.int64)
+        fx = u - x0
+        fy = v - y0
+        if pixel_weights is None:
+            pixel_weights = np.ones(len(u))
+        for dx, dy, corner_weight in ((0, 0, (1 - fx)*(1 - fy)), (1, 0, fx*(1 - fy)),
+                                      (0, 1, (1 - fx)*fy), (1, 1, fx*fy)):
+            x_cell = x0 + dx
+            y_cell = y0 + dy
+            inside = (x_cell >= 0) & (x_cell < self.cols) & (y_cell >= 0) & (y_cell < self.rows)
+            np.add.at(self.confidence[layer], y_cell[inside]*self.cols + x_cell[inside],
+                      (corner_weight*pixel_weights)[inside])
+
+    # Add the fused hits, rounded to counts, to an OccupancyGrid.
+    # Returns the cells observed for the first time in each layer.
+    def apply(self, grid):
+        new_cells = []
+        for layer in range(self.confidence.shape[0]):
+            hits = np.rint(self.confidence[layer]).astype(np.int64)
+            cells = np.flatnonzero(hits)
+            new_cells.append(grid.add_counts(cells, hits[cells], layer))
+        return new_cells
+
+# Fuse the output of batch_perception.perceive_batch
+def fuse_batch_result(fusion, result, xpos, ypos, yaw, weights=None):
+    for name, layer in (('obs', OBSTACLE), ('rock', ROCK), ('nav', NAVIGABLE)):
+        frame, xpix, ypix = result[name + '_rover']
+        fusion.fuse(layer, xpix, ypix, frame, xpos, ypos, yaw, weights)
+
+if __name__ == '__main__':
+    from batch_perception import load_telemetry_log, perceive_batch_parallel
+    from occupancy_grid import OccupancyGrid
+    from map_metrics import MapMetrics
+    from rover_state import ground_truth_3d
+
+    parser = argparse.ArgumentParser(description='Rebuild a world map from a telemetry log')
+    parser.add_argument('log', type=str, help='Telemetry log recorded with drive_rover.py --record.')
+    parser.add_argument('--splat', type=str, default='nearest', choices=['nearest', 'bilinear'])
+    parser.add_argument('--pose_weights', action='store_true', help='Weight frames by their attitude.')
+    parser.add_argument('--workers', type=int, default=1, help='Worker processes for perception.')
+    args = parser.parse_args()
+
+    images, poses = load_telemetry_log(args.log)
+    xpos, ypos, yaw, pitch, roll = poses.T
+    start = time.perf_counter()
+    result = perceive_batch_parallel(images, xpos, ypos, yaw, pitch, roll, workers=args.workers)
+    perceived = time.perf_counter()
+    fusion = MapFusion(splat=args.splat)
+    fuse_batch_result(fusion, result, xpos, ypos, yaw, pose_weights(pitch, roll) if args.pose_weights else None)
+    grid = OccupancyGrid(200, 200)
+    metrics = MapMetrics(ground_truth_3d)
+    metrics.add_navigable(*grid.unravel(fusion.apply(grid)[NAVIGABLE]))
+    fused = time.perf_counter()
+    print('{} frames: perception {:.2f} s, fusion {:.3f} s'.format(len(images), perceived - start, fused - perceived))
+    print('Mapped: {}%, fidelity: {}%'.format(metrics.perc_mapped(), metrics.fidelity()))
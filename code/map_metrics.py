@@ -0,0 +1,40 @@
+import numpy as np
+
+
+# Map quality statistics kept as running totals.  Worldmap cells never go
+# back to unobserved, so each cell is accounted for once, the first time it
+# is seen, and the cost of an update follows the number of new observations.
+class MapMetrics():
+    def __init__(self, ground_truth):
+        # Ground truth navigable mask, one cell per square meter
+        self.truth = ground_truth[:,:,1] > 0
+        self.tot_map_pix = int(np.count_nonzero(self.truth)) # Ground truth navigable pixels
+        self.tot_nav_pix = 0 # Pixels mapped as navigable
+        self.good_nav_pix = 0 # Mapped navigable pixels matching the ground truth
+        self.bad_nav_pix = 0 # Mapped navigable pixels not in the ground truth
+
+    # Account for cells mapped as navigable for the first time.  Cells are
+    # given in map cell coordinates, cell_size in meters, and the totals are
+    # kept in square meters so that any map resolution compares with the
+    # 1 m ground truth.
+    def add_navigable(self, x_cell, y_cell, cell_size=1.0):
+        x_truth = np.floor((np.asarray(x_cell) + 0.5)*cell_size).astype(np.int64)
+        y_truth = np.floor((np.asarray(y_cell) + 0.5)*cell_size).astype(np.int64)
+        rows, cols = self.truth.shape
+        inside = (x_truth >= 0) & (x_truth < cols) & (y_truth >= 0) & (y_truth < rows)
+        good = np.count_nonzero(self.truth[y_truth[inside], x_truth[inside]])
+        area = cell_size**2
+        self.tot_nav_pix += len(x_truth)*area
+        self.good_nav_pix += good*area
+        self.bad_nav_pix += (len(x_truth) - good)*area
+
+    # Percentage of the ground truth map that has been successfully found
+    def perc_mapped(self):
+        return round(100*self.good_nav_pix/self.tot_map_pix, 1)
+
+    # Good map pixel detections divided by total pixels found to be navigable
+    def fidelity(self):
+        if self.tot_nav_pix > 0:
+            return round(100*self.good_nav_pix/self.tot_nav_pix, 1)
+        return 0
+
@@ -0,0 +1,66 @@
+import numpy as np
+
+# Angular sectors of the half plane in front of the rover, in degrees
+SECTORS = 36
+SECTOR_EDGES = np.linspace(-90, 90, SECTORS + 1)
+SECTOR_CENTERS = (SECTOR_EDGES[:-1] + SECTOR_EDGES[1:])/2
+# Per-pixel quantities summed over the pixels of a class
+WEIGHTS = ('angle', 'sin', 'cos', 'dist', 'dist_angle')
+
+
+# Sector of angles in radians
+def sector_of(angles):
+    return np.clip(np.int_((np.asarray(angles)*180/np.pi + 90)*SECTORS/180), 0, SECTORS - 1)
+
+# Per-pixel sector (uint8) and (WEIGHTS, pixels) float32 weights of pixels
+# at the given angles (radians) and distances, laid out for pixel_sums
+def pixel_weights(angles, dists):
+    angles = np.asarray(angles, dtype=np.float64)
+    dists = np.asarray(dists, dtype=np.float64)
+    weights = np.stack((angles, np.sin(angles), np.cos(angles), dists, dists*angles))
+    return sector_of(angles).astype(np.uint8), np.float32(weights)
+
+# Summary sums of the selected pixels: the pixel count of every sector,
+# counted with np.bincount, followed by the totals of the weights
+def pixel_sums(sector, weights, idx):
+    sums = np.empty(SECTORS + len(WEIGHTS))
+    sums[:SECTORS] = np.bincount(sector[idx], minlength=SECTORS)
+    # A dense 0/1 selection times the weight rows is a single BLAS product,
+    # cheaper than gathering the selected columns of every weight
+    selected = np.zeros(weights.shape[1], dtype=np.float32)
+    selected[idx] = 1
+    sums[SECTORS:] = weights @ selected
+    return sums
+
+# Compact summary of the pixels of one class in rover space, in place of
+# the per-pixel angle and distance arrays.  Summaries of sampled pixels are
+# scaled by multiplying their sums, and summaries of disjoint pixel sets
+# are merged by adding them.  Angles are in degrees, the means are zero
+# when there are no pixels.
+class NavSummary():
+    def __init__(self, sums):
+        self.sums = sums # Pixels per sector then the totals of WEIGHTS
+        self.histogram = sums[:SECTORS] # Pixels per sector, free space when navigable
+        angle, sin, cos, dist, dist_angle = sums[SECTORS:]
+        count = self.histogram.sum()
+        self.count = int(round(count)) # Pixels at full resolution
+        self.mean = np.degrees(angle/count) if count else 0. # Arithmetic mean angle
+        self.circular_mean = np.degrees(np.arctan2(sin, cos)) if count else 0.
+        self.weighted_mean = np.degrees(dist_angle/dist) if dist else 0. # Distance-weighted mean angle
+        self.mean_dist = dist/count if count else 0. # Mean distance in pixels
+
+    # Angle below which q percent of the pixels lie, interpolated within
+    # the sector it falls in
+    def percentile(self, q):
+        cumulative = np.cumsum(self.histogram)
+        if cumulative[-1] == 0:
+            return 0.
+        target = q/100*cumulative[-1]
+        sector = min(int(np.searchsorted(cumulative, target)), SECTORS - 1)
+        before = cumulative[sector - 1] if sector > 0 else 0.
+        fraction = (target - before)/self.histogram[sector] if self.histogram[sector] else 0.
+        return SECTOR_EDGES[sector] + fraction*(SECTOR_EDGES[sector + 1] - SECTOR_EDGES[sector])
+
+    # Pixels in the sectors left (positive angles) and right of the heading
+    def sides(self):
+        return self.histogram[SECTOR_CENTERS > 0].sum(), self.histogram[SECTOR_CENTERS < 0].sum()
@@ -0,0 +1,90 @@
+import numpy as np
+
+# Layers of the worldmap
+OBSTACLE = 0
+ROCK = 1
+NAVIGABLE = 2
+
+
+# Compact world map storing saturating hit counts per layer.  Running
+# statistics of the nonzero cells are kept up to date on every update so
+# that display normalization does not need to scan the whole map.
+class OccupancyGrid():
+    def __init__(self, rows, cols, layers=3, dtype=np.uint16):
+        self.rows = rows
+        self.cols = cols
+        self.layers = layers
+        self.cell_size = 1.0 # Cell side in meters
+        # Each layer is stored contiguously, counts is the (row, col, layer) view
+        self.data = np.zeros((layers, rows, cols), dtype=dtype)
+        self.counts = np.moveaxis(self.data, 0, -1)
+        self.max_count = np.iinfo(dtype).max # Counts saturate at this value
+        self.nonzero_count = np.zeros(layers, dtype=np.int64) # Observed cells per layer
+        self.total = np.zeros(layers, dtype=np.int64) # Sum of counts per layer
+
+    @property
+    def shape(self):
+        return self.counts.shape
+
+    # Index like the former (rows, cols, layers) float array
+    def __getitem__(self, key):
+        return self.counts[key]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.counts, dtype=dtype)
+
+    def layer(self, layer):
+        return self.data[layer]
+
+    # Copy of the counts of a layer for display, the grid having the 1 m
+    # cells of the ground truth map the display is drawn at
+    def inset(self, layer, shape):
+        return self.data[layer].copy()
+
+    # World coordinates in meters to cell coordinates, clipped to the map
+    def world_to_cells(self, x_world, y_world):
+        return (np.clip(np.int_(x_world), 0, self.cols - 1),
+                np.clip(np.int_(y_world), 0, self.rows - 1))
+
+    # Flat cell indices to (x, y) cell coordinates
+    def unravel(self, cells):
+        return cells % self.cols, cells // self.cols
+
+    # Counts of the given cells, zero outside the map
+    def values(self, layer, ypix, xpix):
+        ypix = np.asarray(ypix, dtype=np.int64)
+        xpix = np.asarray(xpix, dtype=np.int64)
+        inside = (ypix >= 0) & (ypix < self.rows) & (xpix >= 0) & (xpix < self.cols)
+        out = np.zeros(ypix.shape, dtype=self.data.dtype)
+        out[inside] = self.data[layer][ypix[inside], xpix[inside]]
+        return out
+
+    # Add one hit per (y, x) pair, duplicates within a call all count.
+    # Returns the flat indices of the cells that were observed for the first time.
+    def add(self, ypix, xpix, layer):
+        if len(ypix) == 0:
+            return np.zeros(0, dtype=np.int64)
+        flat = np.asarray(ypix, dtype=np.int64)*self.cols + np.asarray(xpix, dtype=np.int64)
+        cells, hits = np.unique(flat, return_counts=True)
+        return self.add_counts(cells, hits, layer)
+
+    # Add hits to unique flat cell indices, e.g. binned from many frames at once.
+    # Returns the flat indices of the cells that were observed for the first time.
+    def add_counts(self, cells, hits, layer):
+        counts = self.data[layer].reshape(-1)
+        old = counts[cells].astype(np.int64)
+        new = np.minimum(old + hits, self.max_count)
+        counts[cells] = new
+        new_cells = cells[old == 0]
+        self.total[layer] += np.sum(new - old)
+        self.nonzero_count[layer] += len(new_cells)
+        return new_cells
+
+    # Mean count of the observed cells of a layer, in constant time
+    def mean(self, layer):
+        if self.nonzero_count[layer] == 0:
+            return 0.
+        return self.total[layer] / self.nonzero_count[layer]
+
+    def any(self, layer):
+        return self.nonzero_count[layer] > 0
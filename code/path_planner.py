@@ -0,0 +1,241 @@
+import heapq
+import math
+import time
+import numpy as np
+
+from occupancy_grid import OBSTACLE, NAVIGABLE
+
+# Cost of entering a cell by its worldmap status
+NAVIGABLE_COST = 1
+UNKNOWN_COST = 2
+OBSTACLE_COST = 50 # Finite, so that a rover on a misclassified cell can still leave it
+
+# 8-connected moves and their lengths in cells, plain floats as the search
+# runs in pure Python
+SQRT2 = math.sqrt(2)
+MOVES = ((1, 0, 1.), (-1, 0, 1.), (0, 1, 1.), (0, -1, 1.),
+         (1, 1, SQRT2), (1, -1, SQRT2), (-1, 1, SQRT2), (-1, -1, SQRT2))
+INF = math.inf
+
+
+# Octile distance, admissible with a minimum cell cost of 1
+def octile(a, b):
+    dx = abs(a[0] - b[0])
+    dy = abs(a[1] - b[1])
+    return max(dx, dy) + (SQRT2 - 1)*min(dx, dy)
+
+
+# D* Lite over the worldmap cells (Koenig and Likhachev, 2002).  The search
+# runs backwards from the goal, so when the rover moves the key modifier km
+# keeps the queue valid, and when cells change status only those cells and
+# their neighbours are repaired.  Every call to plan() expands at most
+# max_expansions cells in at most max_time seconds; an unfinished search
+# resumes on the next frame.
+class PathPlanner():
+    def __init__(self, bounds, max_expansions=2000, max_time=0.005, lookahead=3):
+        self.bounds = bounds # (x0, y0, x1, y1) cells searched, x1 and y1 excluded
+        self.max_expansions = max_expansions # Expansion budget per frame
+        self.max_time = max_time # Time budget per frame in seconds
+        self.lookahead = lookahead # Distance in meters of the followed waypoint
+        self.costs = {} # (x, y) -> cost of cells observed so far, unknown otherwise
+        self.changed = [] # Cells whose cost changed in the last update_cells()
+        self.goal = None
+        self.reset()
+        self.expansions = 0 # Cells expanded by the last call to plan()
+        self.plan_time = 0. # Duration in seconds of the last call to plan()
+
+    def reset(self, goal=None, start=None):
+        self.goal = goal
+        self.start = start
+        self.last = start # Start at the last km update
+        self.km = 0.
+        self.g = {}
+        self.rhs = {}
+        self.queue = [] # Heap of (key, cell), stale entries are skipped
+        self.queued = {} # cell -> current key
+        if goal is not None:
+            self.rhs[goal] = 0.
+            self.push(goal)
+
+    def cost(self, cell):
+        return self.costs.get(cell, UNKNOWN_COST)
+
+    def inside(self, cell):
+        x0, y0, x1, y1 = self.bounds
+        return x0 <= cell[0] < x1 and y0 <= cell[1] < y1
+
+    def neighbours(self, cell):
+        x, y = cell
+        for dx, dy, length in MOVES:
+            other = (x + dx, y + dy)
+            if self.inside(other):
+                yield other, length
+
+    # Symmetric edge cost, the length times the cost of the worse end
+    def edge(self, a, b, length):
+        return length*max(self.cost(a), self.cost(b))
+
+    def key(self, cell):
+        best = min(self.g.get(cell, INF), self.rhs.get(cell, INF))
+        return (best + octile(self.start, cell) + self.km, best)
+
+    def push(self, cell):
+        key = self.key(cell)
+        self.queued[cell] = key
+        heapq.heappush(self.queue, (key, cell))
+
+    # Recompute rhs from the neighbours, this is the inner loop of the search
+    def update_vertex(self, cell):
+        if cell != self.goal:
+            x, y = cell
+            x0, y0, x1, y1 = self.bounds
+            costs = self.costs
+            g = self.g
+            own = costs.get(cell, UNKNOWN_COST)
+            best = INF
+            for dx, dy, length in MOVES:
+                other = (x + dx, y + dy)
+                g_other = g.get(other, INF)
+                if g_other < best and x0 <= other[0] < x1 and y0 <= other[1] < y1:
+                    best = min(best, g_other + length*max(own, costs.get(other, UNKNOWN_COST)))
+            self.rhs[cell] = best
+        self.queued.pop(cell, None)
+        if self.g.get(cell, INF) != self.rhs.get(cell, INF):
+            self.push(cell)
+
+    # Pop the queue until the start is consistent or the budget of
+    # expansions or time is spent.  Returns True when the start is consistent.
+    def compute(self, budget, deadline):
+        while self.queue and budget > 0:
+            if budget % 16 == 0 and time.perf_counter() > deadline:
+                break
+            key, cell = self.queue[0]
+            if self.queued.get(cell) != key:
+                heapq.heappop(self.queue)
+                continue
+            start_key = self.key(self.start)
+            start_g = self.g.get(self.start, INF)
+            if key >= start_key and self.rhs.get(self.start, INF) == start_g:
+                return True
+            heapq.heappop(self.queue)
+            budget -= 1
+            self.expansions += 1
+            new_key = self.key(cell)
+            g = self.g.get(cell, INF)
+            rhs = self.rhs.get(cell, INF)
+            if key < new_key:
+                self.push(cell)
+            elif g > rhs:
+                del self.queued[cell]
+                self.g[cell] = rhs
+                for other, _ in self.neighbours(cell):
+                    self.update_vertex(other)
+            else:
+                del self.queued[cell]
+                self.g[cell] = INF
+                self.update_vertex(cell)
+                for other, _ in self.neighbours(cell):
+                    self.update_vertex(other)
+        return self.rhs.get(self.start, INF) == self.g.get(self.start, INF) < INF
+
+    # Refresh the cost of the cells hit this frame, repairing the search
+    # around the cells whose status changed.  The changed cells are kept in
+    # self.changed until the next call.
+    def update_cells(self, worldmap, xcell, ycell):
+        self.changed = []
+        if len(xcell) == 0:
+            return
+        hit = np.unique(np.stack((xcell, ycell), axis=1).astype(np.int64), axis=0)
+        nav = worldmap.values(NAVIGABLE, hit[:,1], hit[:,0])
+        obs = worldmap.values(OBSTACLE, hit[:,1], hit[:,0])
+        costs = np.where(nav >= obs, NAVIGABLE_COST, OBSTACLE_COST)
+        for x, y, cost in zip(hit[:,0].tolist(), hit[:,1].tolist(), costs.tolist()):
+            cell = (x, y)
+            if self.cost(cell) == cost:
+                continue
+            self.costs[cell] = cost
+            self.changed.append(cell)
+            if self.goal is not None and self.start is not None:
+                self.update_vertex(cell)
+                for other, _ in self.neighbours(cell):
+                    self.update_vertex(other)
+
+    # Advance the search from the rover cell towards the goal cell.
+    # Returns True when the path from start is known.
+    def plan(self, start, goal):
+        started = time.perf_counter()
+        self.expansions = 0
+        if goal != self.goal or self.start is None:
+            self.reset(goal, start)
+        elif start != self.start:
+            self.km += octile(self.last, start)
+            self.last = start
+            self.start = start
+        found = self.compute(self.max_expansions, started + self.max_time)
+        self.plan_time = time.perf_counter() - started
+        return found
+
+    # Cells from the start following the steepest descent of g
+    def path(self, max_cells=500):
+        cell = self.start
+        cells = [cell]
+        while cell != self.goal and len(cells) < max_cells:
+            best = min(self.neighbours(cell), default=None,
+                       key=lambda item: self.edge(cell, item[0], item[1]) + self.g.get(item[0], INF))
+            if best is None or self.g.get(best[0], INF) == INF:
+                break
+            cell = best[0]
+            cells.append(cell)
+        return cells
+
+    # First path cell at least lookahead meters away (or the last one), in meters
+    def waypoint(self, cell_size=1.0):
+        cells = self.path()
+        for cell in cells[1:]:
+            if octile(cell, self.start)*cell_size >= self.lookahead:
+                break
+        else:
+            cell = cells[-1]
+        return ((cell[0] + 0.5)*cell_size, (cell[1] + 0.5)*cell_size)
+
+
+# One-shot A* between two cells with the same cost model as PathPlanner.
+# Returns the path cost and cells, or (inf, []) when the expansion budget
+# runs out first.
+def astar(costs, bounds, start, goal, max_expansions=20000):
+    x0, y0, x1, y1 = bounds
+    g = {start: 0.}
+    parent = {start: None}
+    queue = [(octile(start, goal), start)]
+    closed = set()
+    while queue and len(closed) < max_expansions:
+        _, cell = heapq.heappop(queue)
+        if cell == goal:
+            cells = []
+            while cell is not None:
+                cells.append(cell)
+                cell = parent[cell]
+            return g[goal], cells[::-1]
+        if cell in closed:
+            continue
+        closed.add(cell)
+        x, y = cell
+        own = costs.get(cell, UNKNOWN_COST)
+        for dx, dy, length in MOVES:
+            other = (x + dx, y + dy)
+            if not (x0 <= other[0] < x1 and y0 <= other[1] < y1) or other in closed:
+                continue
+            g_other = g[cell] + length*max(own, costs.get(other, UNKNOWN_COST))
+            if g_other < g.get(other, INF):
+                g[other] = g_other
+                parent[other] = cell
+                heapq.heappush(queue, (g_other + octile(other, goal), other))
+    return INF, []
+
+# Search bounds in cells for a worldmap
+def map_bounds(worldmap):
+    if hasattr(worldmap, 'extent'):
+        x, y, width, height = worldmap.extent
+        return (int(np.floor(x / worldmap.cell_size)), int(np.floor(y / worldmap.cell_size)),
+                int(np.ceil((x + width) / worldmap.cell_size)), int(np.ceil((y + height) / worldmap.cell_size)))
+    return (0, 0, worldmap.cols, worldmap.rows)
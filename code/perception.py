@@ -1,6 +1,48 @@
+import time
 import numpy as np
 import cv2
-from supporting_functions import wrap_angle_180
+from camera_model import CameraModel, pixel_table
+from pixel_classifier import PixelClassifier, ClassBuffers
+from occupancy_grid import OBSTACLE, ROCK, NAVIGABLE
+from rock_index import located_samples
+from profiling import profiler
+from adaptive_resolution import nav_statistics, statistics_error
+from nav_summary import NavSummary, SECTORS, WEIGHTS
+from perception_kernels import KERNELS, KernelBuffers, perceive_pixels
+
+# Camera image corners of a 1 m grid square on the ground in front of the rover
+CAMERA_SOURCE = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
+# Fused navigable/obstacle/rock classifier, its RGB table is read only once built
+classifier = PixelClassifier()
+# Full frames go through the fused kernel when it is compiled
+use_kernels = KERNELS
+# Pixels in front of the rover kept for mapping and for locating rocks
+MAP_CROP = 20
+ROCK_CROP = 30
+
+
+# Everything perception writes to while processing a frame: the camera
+# model, recalibrated only when needed, and the classifier and kernel
+# output buffers by image shape.  Every rover owns one, so rovers
+# perceived concurrently on pipeline threads never share a buffer.
+class PerceptionBuffers():
+    def __init__(self):
+        self.camera = CameraModel() # Camera model with its warp tables and regions
+        self.classes = {} # Image shape -> ClassBuffers
+        self.kernels = {} # Image shape (rows, cols) -> KernelBuffers
+
+    def class_buffers(self, shape):
+        if shape not in self.classes:
+            self.classes[shape] = ClassBuffers(shape)
+        return self.classes[shape]
+
+    def kernel_buffers(self, shape):
+        if shape not in self.kernels:
+            self.kernels[shape] = KernelBuffers(shape)
+        return self.kernels[shape]
+
+# Buffers of the helpers called outside perception_step, such as the benchmarks
+shared_buffers = PerceptionBuffers()
 
 
 # Identify pixels above the threshold
@@ -46,26 +88,10 @@ def rocks_thresh(img):
     
     return rocks_select_bin
 
-# Define a function to convert from image coords to rover coords
-def rover_coords(binary_img):
-    # Identify nonzero pixels
-    ypos, xpos = binary_img.nonzero()
-    # Calculate pixel positions with reference to the rover position being at the 
-    # center bottom of the image.  
-    x_pixel = -(ypos - binary_img.shape[0]).astype(np.float)
-    y_pixel = -(xpos - binary_img.shape[1]/2 ).astype(np.float)
-    return x_pixel, y_pixel
-
-
-# Define a function to convert to radial coords in rover space
-def to_polar_coords(x_pixel, y_pixel):
-    # Convert (x_pixel, y_pixel) to (distance, angle) 
-    # in polar coordinates in rover space
-    # Calculate distance to each pixel
-    dist = np.sqrt(x_pixel**2 + y_pixel**2)
-    # Calculate angle away from vertical for each pixel
-    angles = np.arctan2(y_pixel, x_pixel)
-    return dist, angles
+# Classify navigable terrain, obstacles and rocks in a single pass
+# The returned masks live in preallocated buffers reused on every frame
+def classify_pixels(img, mask, buffers=shared_buffers):
+    return classifier.classify(img, mask, buffers.class_buffers(img.shape))
 
 # Define a function to map rover space pixels to world space
 def rotate_pix(xpix, ypix, yaw):
@@ -84,27 +110,28 @@ def translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale):
     # Return the result  
     return xpix_translated, ypix_translated
 
-
-# Define a function to apply rotation and translation (and clipping)
-# Once you define the two functions above this function should work
-def pix_to_world(xpix, ypix, xpos, ypos, yaw, world_size, scale):
-    # Apply rotation
+# Convert rover-centric pixels to worldmap cells, the worldmap decides the
+# cell size and whether cells off the map are clipped to its border
+def pix_to_cells(xpix, ypix, xpos, ypos, yaw, scale, worldmap):
     xpix_rot, ypix_rot = rotate_pix(xpix, ypix, yaw)
-    # Apply translation
     xpix_tran, ypix_tran = translate_pix(xpix_rot, ypix_rot, xpos, ypos, scale)
-    # Perform rotation, translation and clipping all at once
-    x_pix_world = np.clip(np.int_(xpix_tran), 0, world_size - 1)
-    y_pix_world = np.clip(np.int_(ypix_tran), 0, world_size - 1)
-    # Return the result
-    return x_pix_world, y_pix_world
+    return worldmap.world_to_cells(xpix_tran, ypix_tran)
 
 # Define a function to perform a perspective transform
-def perspect_transform(img, src, dst):
-           
-    M = cv2.getPerspectiveTransform(src, dst)
-    warped = cv2.warpPerspective(img, M, (img.shape[1], img.shape[0]))# keep same size as input image
-    mask = cv2.warpPerspective(np.ones_like(img[:,:,0]), M, (img.shape[1], img.shape[0]))
-    return warped, mask
+# The homography, remap table and visibility mask are cached in the camera
+# model, so only the image itself is warped on each call
+def perspect_transform(img, src, dst, camera=shared_buffers.camera):
+    camera.calibrate(img.shape, src, dst)
+    warped = camera.warp(img) # keep same size as input image
+    return warped, camera.mask
+
+# Destination points of the calibration grid square in the top-down view
+def perspective_destination(shape, dst_size=5, bottom_offset=6):
+    return np.float32([[shape[1]/2 - dst_size, shape[0] - bottom_offset],
+                      [shape[1]/2 + dst_size, shape[0] - bottom_offset],
+                      [shape[1]/2 + dst_size, shape[0] - 2*dst_size - bottom_offset], 
+                      [shape[1]/2 - dst_size, shape[0] - 2*dst_size - bottom_offset],
+                      ])
 
 # Crop x and y pixel values to improve fidelity
 def crop_xy(xpix, ypix, crop_value):
@@ -112,112 +139,233 @@ def crop_xy(xpix, ypix, crop_value):
     xpix_crop = xpix[xpix<crop_value]
     return xpix_crop, ypix_crop
 
+# Warp region of the rows that survive the crops, at full resolution
+def near_region(camera, shape):
+    rows, cols = shape[:2]
+    return camera.region(slice(rows - ROCK_CROP + 1, rows), slice(0, cols))
+
+# Warp region sampling the whole top-down view every step pixels
+def sample_region(camera, shape, step):
+    rows, cols = shape[:2]
+    return camera.region(slice(step//2, rows, step), slice(step//2, cols, step))
+
 def samples_diff(Rover):
     samples_posx = Rover.samples_pos[0][:]
     samples_posy = Rover.samples_pos[1][:]
     samples_posx_detected = Rover.samples_pos_detected[:,0]
-    mask = np.in1d(samples_posx, samples_posx_detected,invert=True)
+    mask = np.isin(samples_posx, samples_posx_detected,invert=True)
     samples_posx_diff = samples_posx[mask]
     samples_posy_diff = samples_posy[mask]
 
     return samples_posx_diff, samples_posy_diff
 def update_rocks(Rover):
-    # Check whether any rock detections are present in worldmap
-    rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-    # If there are, we'll step through the known sample positions
-    # to confirm whether detections are real
-
+    # Step through the known sample positions not detected yet and
+    # confirm them against the spatial index of rock detections
     samples_posx_diff, samples_posy_diff = samples_diff(Rover)
-    samples_located = Rover.samples_located;
-    if rock_world_pos[0].any():
-        for idx in range(len(samples_posx_diff)):
-            test_rock_x = samples_posx_diff[idx]
-            test_rock_y = samples_posy_diff[idx]
-            rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                (test_rock_y - rock_world_pos[0])**2)
-            # if rocks were detected within 3 meters of known sample positions
-            # consider it a success and plot the location of the known
-            # sample on the map
-            if np.min(rock_sample_dists) < 3:
-                Rover.samples_pos_detected[samples_located,:] = [test_rock_x,test_rock_y]
-                Rover.samples_located += 1
+    confirmed = located_samples(Rover.rock_index, (samples_posx_diff, samples_posy_diff))
+    for idx in np.flatnonzero(confirmed):
+        # if rocks were detected within 3 meters of known sample positions
+        # consider it a success
+        Rover.samples_pos_detected[Rover.samples_located,:] = [samples_posx_diff[idx],samples_posy_diff[idx]]
+        Rover.samples_located += 1
     
     return Rover
 
-# Apply the above functions in succession and update the Rover state accordingly
-def perception_step(Rover):
-    # Perform perception steps to update Rover()
-    # TODO: 
-    # NOTE: camera image is coming to you in Rover.img
+# Warp and classify the whole camera frame.  Sets the navigable terrain
+# and rock sample fields of Rover and returns the navigable mask and the
+# cropped rover-centric navigable, obstacle and rock pixels to map.
+def perceive_full(Rover, lap):
     # 1) Define source and destination points for perspective transform
-    dst_size = 5 
-    bottom_offset = 6
-    source = np.float32([[14, 140], [301 ,140],[200, 96], [118, 96]])
-    destination = np.float32([[Rover.img.shape[1]/2 - dst_size, Rover.img.shape[0] - bottom_offset],
-                      [Rover.img.shape[1]/2 + dst_size, Rover.img.shape[0] - bottom_offset],
-                      [Rover.img.shape[1]/2 + dst_size, Rover.img.shape[0] - 2*dst_size - bottom_offset], 
-                      [Rover.img.shape[1]/2 - dst_size, Rover.img.shape[0] - 2*dst_size - bottom_offset],
-                      ])
+    source = CAMERA_SOURCE
+    destination = perspective_destination(Rover.img.shape)
     # 2) Apply perspective transform
-    warped, mask = perspect_transform(Rover.img, source, destination)
+    warped, mask = perspect_transform(Rover.img, source, destination, Rover.perception.camera)
+    lap('perception.warp')
     # 3) Apply color threshold to identify navigable terrain/obstacles/rock samples
-    threshed = color_thresh(warped)
-    obs_area = obstacle_thresh(warped, mask)
-    rocks_area = rocks_thresh(warped)
+    threshed, obs_area, rocks_area = classify_pixels(warped, mask, Rover.perception)
 
     # 4) Update Rover.vision_image (this will be displayed on left side of screen)
         # Example: Rover.vision_image[:,:,0] = obstacle color-thresholded binary image
         #          Rover.vision_image[:,:,1] = rock_sample color-thresholded binary image
         #          Rover.vision_image[:,:,2] = navigable terrain color-thresholded binary image
-    Rover.vision_image[:,:,0] = obs_area*255
-    Rover.vision_image[:,:,1] = rocks_area*255
-    Rover.vision_image[:,:,2] = threshed*255
+    np.multiply(obs_area, 255, out=Rover.vision_image[:,:,0])
+    np.multiply(rocks_area, 255, out=Rover.vision_image[:,:,1])
+    np.multiply(threshed, 255, out=Rover.vision_image[:,:,2])
+    lap('perception.threshold')
     # 5) Convert map image pixel values to rover-centric coords
-    xpos = Rover.pos[0]
-    ypos = Rover.pos[1]
-    yaw = Rover.yaw
-
-    
-    xpix, ypix = rover_coords(threshed)
-    xpix_rocks, ypix_rocks = rover_coords(rocks_area)
-    xpix_rocks_crop, ypix_rocks_crop = crop_xy(xpix_rocks, ypix_rocks, 30)
-    # 8) Convert rover-centric pixel positions to polar coordinates
-    # Update Rover pixel distances and angles
-        # Rover.nav_dists = rover_centric_pixel_distances
-        # Rover.nav_angles = rover_centric_angles
-    dist, angles = to_polar_coords(xpix, ypix)
-    dist_rocks, angles_rocks = to_polar_coords(xpix_rocks, ypix_rocks)
-    Rover.nav_dists = dist
-    Rover.nav_angles = angles
-    Rover.rocks_angles = angles_rocks
+    table = pixel_table(threshed.shape)
+    nav_idx = table.indices(threshed)
+    rocks_idx = table.indices(rocks_area)
+    xpix, ypix = table.coords(nav_idx)
+    xpix_rocks, ypix_rocks = table.coords(rocks_idx)
+    xpix_obs, ypix_obs = table.coords(table.indices(obs_area))
+    # 8) Summarize the rover-centric pixels in polar coordinates
+    # The summary sums are gathered from the precomputed pixel angles and distances
+    Rover.nav = NavSummary(table.sums(nav_idx))
+    Rover.rocks = NavSummary(table.sums(rocks_idx))
     if xpix_rocks.any():
         Rover.sample_in_sight = True
     else:
         Rover.sample_in_sight = False
-    
+    lap('perception.coords')
+    # Crop values
+    return threshed, (crop_xy(xpix, ypix, MAP_CROP), crop_xy(xpix_obs, ypix_obs, MAP_CROP),
+                      crop_xy(xpix_rocks, ypix_rocks, ROCK_CROP))
+
+# perceive_full in a single pass of the fused kernel.  Returns the
+# navigable mask and the world positions in meters of the navigable,
+# obstacle and rock pixels to map, empty unless mapping, as views of
+# buffers overwritten by the next frame.
+def perceive_fused(Rover, mapping, lap):
+    warped, mask = perspect_transform(Rover.img, CAMERA_SOURCE, perspective_destination(Rover.img.shape),
+                                      Rover.perception.camera)
+    lap('perception.warp')
+    shape = warped.shape[:2]
+    buffers = Rover.perception.kernel_buffers(shape)
+    table = pixel_table(shape)
+    yaw_rad = Rover.yaw * np.pi / 180
+    nav_sums = np.zeros(SECTORS + len(WEIGHTS))
+    rock_sums = np.zeros(SECTORS + len(WEIGHTS))
+    perceive_pixels(warped, mask, classifier.table(), table.x, table.y, table.sector, table.weights,
+                    np.cos(yaw_rad), np.sin(yaw_rad), Rover.pos[0], Rover.pos[1], Rover.config.dst_scale,
+                    MAP_CROP, ROCK_CROP, mapping, Rover.vision_image, nav_sums, rock_sums,
+                    buffers.nav_world, buffers.obs_world, buffers.rock_world, buffers.counts)
+    n_nav_map, n_obs_map, n_rock_map = buffers.counts.tolist()
+    Rover.nav = NavSummary(nav_sums)
+    Rover.rocks = NavSummary(rock_sums)
+    Rover.sample_in_sight = Rover.rocks.count > 0
+    lap('perception.kernel')
+    return Rover.vision_image[:,:,2], (buffers.nav_world[:,:n_nav_map], buffers.obs_world[:,:n_obs_map],
+                                       buffers.rock_world[:,:n_rock_map])
+
+# Warp only what the rover uses: the rows that survive the crops at full
+# resolution, and the whole view sampled every step pixels for the
+# navigable terrain statistics.  Sets the same Rover fields as
+# perceive_full, the sampled pixels counting for step x step pixels, and
+# returns the same cropped pixels, which are identical to the full path.
+def perceive_roi(Rover, step, lap):
+    rows, cols = Rover.img.shape[:2]
+    camera = Rover.perception.camera
+    camera.calibrate(Rover.img.shape, CAMERA_SOURCE, perspective_destination(Rover.img.shape))
+    near = near_region(camera, Rover.img.shape)
+    sample = sample_region(camera, Rover.img.shape, step)
+    near_warped = near.warp(Rover.img)
+    sample_warped = sample.warp(Rover.img)
+    lap('perception.warp')
+    near_nav, near_obs, near_rocks = classify_pixels(near_warped, near.mask, Rover.perception)
+    threshed, obs_area, rocks_area = classify_pixels(sample_warped, sample.mask, Rover.perception)
+    # The vision image shows the sampled view, with the near rows at full resolution
+    for channel, sampled, near_mask in ((0, obs_area, near_obs), (1, rocks_area, near_rocks),
+                                        (2, threshed, near_nav)):
+        vision = cv2.resize(sampled, (cols, rows), interpolation=cv2.INTER_NEAREST)
+        np.multiply(vision, 255, out=Rover.vision_image[:,:,channel])
+        np.multiply(near_mask, 255, out=Rover.vision_image[near.rows,:,channel])
+    lap('perception.threshold')
+    Rover.nav = NavSummary(sample.table.sums(sample.table.indices(threshed))*(step*step))
+    # Rocks beyond the near rows are sampled, those within at full resolution
+    rocks_idx = sample.table.indices(rocks_area)
+    rocks_idx = rocks_idx[sample.table.x[rocks_idx] >= ROCK_CROP]
+    near_rocks_idx = near.table.indices(near_rocks)
+    Rover.rocks = NavSummary(sample.table.sums(rocks_idx)*(step*step) + near.table.sums(near_rocks_idx))
+    Rover.sample_in_sight = Rover.rocks.count > 0
+    xpix, ypix = near.table.coords(near.table.indices(near_nav))
+    xpix_obs, ypix_obs = near.table.coords(near.table.indices(near_obs))
+    xpix_rocks, ypix_rocks = near.table.coords(near_rocks_idx)
+    lap('perception.coords')
+    return (crop_xy(xpix, ypix, MAP_CROP), crop_xy(xpix_obs, ypix_obs, MAP_CROP),
+            crop_xy(xpix_rocks, ypix_rocks, ROCK_CROP))
+
+# Compare the navigable terrain statistics of every step of the resolution
+# controller with those of the full resolution mask of this frame
+def check_resolution(resolution, camera, threshed):
+    table = pixel_table(threshed.shape)
+    full = nav_statistics(NavSummary(table.sums(table.indices(threshed))))
+    errors = {}
+    for step in resolution.steps[1:]:
+        sample = sample_region(camera, threshed.shape, step)
+        sampled = threshed[sample.rows, sample.cols]
+        sums = sample.table.sums(sample.table.indices(sampled))*(step*step)
+        errors[step] = statistics_error(full, nav_statistics(NavSummary(sums)))
+    resolution.validate(errors)
+
+# Apply the above functions in succession and update the Rover state accordingly
+def perception_step(Rover):
+    # Perform perception steps to update Rover()
+    # TODO: 
+    # NOTE: camera image is coming to you in Rover.img
+    started = time.perf_counter()
+    lap = profiler.laps()
+    # Sampling step of the view, 1 for the full frame
+    resolution = Rover.resolution
+    if resolution is not None:
+        step = resolution.next_step()
+    elif Rover.config.perception_mode == 'roi':
+        step = Rover.config.roi_step
+    else:
+        step = 1
+    mapping = abs(Rover.npitch)<Rover.config.max_pitch and abs(Rover.nroll)<Rover.config.max_roll
+    world = None
+    if step == 1 and use_kernels:
+        threshed, world = perceive_fused(Rover, mapping, lap)
+    elif step == 1:
+        threshed, crops = perceive_full(Rover, lap)
+    else:
+        crops = perceive_roi(Rover, step, lap)
+    xpos = Rover.pos[0]
+    ypos = Rover.pos[1]
+    yaw = Rover.yaw
+
     Rover = update_rocks(Rover)
+    lap('perception.rocks')
     
-    if abs(Rover.npitch)<Rover.max_pitch and abs(Rover.nroll)<Rover.max_roll:
-        xpix_obs, ypix_obs = rover_coords(obs_area)
-        
-        # Crop values
-        xpix_crop, ypix_crop = crop_xy(xpix, ypix, 20)
-        xpix_obs_crop, ypix_obs_crop = crop_xy(xpix_obs, ypix_obs, 20)
-        
+    if mapping:
         # 6) Convert rover-centric pixel values to world coordinates
-        world_size = 200
-        scale = 10
-        x_pix_world, y_pix_world = pix_to_world(xpix_crop, ypix_crop, xpos, ypos, yaw, world_size, scale)
-        x_pix_obs_world, y_pix_obs_world = pix_to_world(xpix_obs_crop, ypix_obs_crop, xpos, ypos, yaw, world_size, scale)
-        x_pix_rck_world, y_pix_rck_world = pix_to_world(xpix_rocks_crop, ypix_rocks_crop, xpos, ypos, yaw, world_size, scale)
+        # The worldmap sets the cell size and whether cells are clipped to its border
+        worldmap = Rover.worldmap
+        scale = Rover.config.dst_scale
+        if world is None:
+            (xpix_crop, ypix_crop), (xpix_obs_crop, ypix_obs_crop), (xpix_rocks_crop, ypix_rocks_crop) = crops
+            x_pix_world, y_pix_world = pix_to_cells(xpix_crop, ypix_crop, xpos, ypos, yaw, scale, worldmap)
+            x_pix_obs_world, y_pix_obs_world = pix_to_cells(xpix_obs_crop, ypix_obs_crop, xpos, ypos, yaw, scale, worldmap)
+            x_pix_rck_world, y_pix_rck_world = pix_to_cells(xpix_rocks_crop, ypix_rocks_crop, xpos, ypos, yaw, scale, worldmap)
+        else:
+            # The kernel already rotated and translated the pixels to meters
+            nav_world, obs_world, rock_world = world
+            x_pix_world, y_pix_world = worldmap.world_to_cells(nav_world[0], nav_world[1])
+            x_pix_obs_world, y_pix_obs_world = worldmap.world_to_cells(obs_world[0], obs_world[1])
+            x_pix_rck_world, y_pix_rck_world = worldmap.world_to_cells(rock_world[0], rock_world[1])
+        lap('perception.world_coords')
         # 7) Update Rover worldmap (to be displayed on right side of screen)
         # Example: Rover.worldmap[obstacle_y_world, obstacle_x_world, 0] += 1
         #          Rover.worldmap[rock_y_world, rock_x_world, 1] += 1
         #          Rover.worldmap[navigable_y_world, navigable_x_world, 2] += 1
         # Worldmap is updadted in case roll and pitch angles are close to zero.
     
-        Rover.worldmap[y_pix_obs_world,x_pix_obs_world, 0] += 1
-        Rover.worldmap[y_pix_rck_world,x_pix_rck_world, 1] += 1
-        Rover.worldmap[y_pix_world,x_pix_world, 2] += 1
+        # Every hit is counted, including repeated cells within this frame
+        worldmap.add(y_pix_obs_world, x_pix_obs_world, OBSTACLE)
+        new_rocks = worldmap.add(y_pix_rck_world, x_pix_rck_world, ROCK)
+        new_nav = worldmap.add(y_pix_world, x_pix_world, NAVIGABLE)
+        # Only the cells observed for the first time change the map statistics
+        x_new_nav, y_new_nav = worldmap.unravel(new_nav)
+        Rover.map_metrics.add_navigable(x_new_nav, y_new_nav, worldmap.cell_size)
+        # Rock detections are indexed in meters
+        x_new_rocks, y_new_rocks = worldmap.unravel(new_rocks)
+        Rover.rock_index.add(x_new_rocks*worldmap.cell_size, y_new_rocks*worldmap.cell_size)
+        lap('perception.map_update')
+        # Frontiers and path costs can only change around the cells hit this frame
+        x_hit = np.concatenate((x_pix_world, x_pix_obs_world))
+        y_hit = np.concatenate((y_pix_world, y_pix_obs_world))
+        if Rover.frontiers is not None:
+            Rover.frontiers.update(worldmap, x_hit, y_hit)
+            lap('perception.frontiers')
+        Rover.path_planner.update_cells(worldmap, x_hit, y_hit)
+        Rover.route.invalidate(Rover.path_planner.changed)
+        lap('perception.path_costs')
 
-    return Rover
\ No newline at end of file
+    if resolution is not None:
+        resolution.record(step, time.perf_counter() - started)
+        if resolution.checking:
+            check_resolution(resolution, Rover.perception.camera, threshed)
+            lap('perception.resolution_check')
+
+    return Rover
@@ -0,0 +1,92 @@
+import numpy as np
+
+# numba is optional: without it the kernel below stays plain Python, which
+# is only fast enough to check it against the NumPy path
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Whether perception uses the compiled kernel
+KERNELS = numba is not None
+
+
+def jit(func):
+    if numba is None:
+        return func
+    return numba.njit(cache=True, nogil=True)(func)
+
+
+# Caller-owned outputs of perceive_pixels for one image shape, sized for
+# every pixel of the frame belonging to the same class
+class KernelBuffers():
+    def __init__(self, shape):
+        rows, cols = shape[:2]
+        self.shape = (rows, cols)
+        size = rows*cols
+        self.nav_world = np.zeros((2, size), dtype=np.float64) # World x, y in meters of the mapped pixels
+        self.obs_world = np.zeros((2, size), dtype=np.float64)
+        self.rock_world = np.zeros((2, size), dtype=np.float64)
+        self.counts = np.zeros(3, dtype=np.int64) # Entries of the above, in order
+
+
+# Classify every pixel of a warped frame with the RGB label table, write
+# the vision image, accumulate the navigation summary sums (sector counts
+# then weight totals) of the navigable and rock pixels from the rover pixel
+# table, and rotate and translate the pixels within the crops to world
+# meters, all in one pass without temporary arrays.  The arithmetic and the
+# pixel order are those of the NumPy path, so the outputs are identical but
+# for the rounding of the weight totals.  nav_sums and rock_sums must start
+# zeroed.  The entries used in each world buffer are returned in counts:
+# the mapped navigable, obstacle and rock pixels (0 unless mapping).
+# test_perception_kernels.py checks both the interpreted and compiled kernel.
+@jit
+def perceive_pixels(img, mask, lut, table_x, table_y, table_sector, table_weights,
+                    cos_yaw, sin_yaw, xpos, ypos, scale, map_crop, rock_crop, mapping,
+                    vision, nav_sums, rock_sums, nav_world, obs_world, rock_world, counts):
+    rows, cols = mask.shape
+    n_weights = table_weights.shape[0]
+    n_sectors = nav_sums.shape[0] - n_weights
+    n_nav_map = 0
+    n_obs_map = 0
+    n_rock_map = 0
+    for row in range(rows):
+        for col in range(cols):
+            idx = row*cols + col
+            label = lut[(int(img[row, col, 0]) << 16) | (int(img[row, col, 1]) << 8) | int(img[row, col, 2])]
+            nav = label & 1
+            rock = label >> 1
+            obs = (nav ^ 1)*mask[row, col]
+            vision[row, col, 0] = obs*255
+            vision[row, col, 1] = rock*255
+            vision[row, col, 2] = nav*255
+            if nav == 0 and rock == 0 and obs == 0:
+                continue
+            x = table_x[idx]
+            y = table_y[idx]
+            sector = table_sector[idx]
+            if nav:
+                nav_sums[sector] += 1
+                for weight in range(n_weights):
+                    nav_sums[n_sectors + weight] += table_weights[weight, idx]
+            if rock:
+                rock_sums[sector] += 1
+                for weight in range(n_weights):
+                    rock_sums[n_sectors + weight] += table_weights[weight, idx]
+            if not mapping:
+                continue
+            if nav and x < map_crop:
+                nav_world[0, n_nav_map] = (x*cos_yaw - y*sin_yaw)/scale + xpos
+                nav_world[1, n_nav_map] = (x*sin_yaw + y*cos_yaw)/scale + ypos
+                n_nav_map += 1
+            if obs and x < map_crop:
+                obs_world[0, n_obs_map] = (x*cos_yaw - y*sin_yaw)/scale + xpos
+                obs_world[1, n_obs_map] = (x*sin_yaw + y*cos_yaw)/scale + ypos
+                n_obs_map += 1
+            if rock and x < rock_crop:
+                rock_world[0, n_rock_map] = (x*cos_yaw - y*sin_yaw)/scale + xpos
+                rock_world[1, n_rock_map] = (x*sin_yaw + y*cos_yaw)/scale + ypos
+                n_rock_map += 1
+    counts[0] = n_nav_map
+    counts[1] = n_obs_map
+    counts[2] = n_rock_map
@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from collections import deque
+import numpy as np
+
+logger = logging.getLogger('rover')
+
+
+# Single-item slot where a new item replaces the one not yet taken,
+# so the consumer always works on the most recent frame
+class LatestSlot():
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.item = None
+        self.dropped = 0 # Items replaced before being taken
+
+    def put(self, item):
+        with self.condition:
+            if self.item is not None:
+                self.dropped += 1
+            self.item = item
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        with self.condition:
+            if self.item is None:
+                self.condition.wait(timeout)
+            item, self.item = self.item, None
+            return item
+
+
+# Result of processing one telemetry frame
+class FrameResult():
+    def __init__(self, arrival, commands, pickup, images):
+        self.arrival = arrival # Time the telemetry frame was received
+        self.commands = commands # (throttle, brake, steer)
+        self.pickup = pickup # Send the pickup command instead of the controls
+        self.images = images # Inset image strings
+        self.emitted = False # Already acted upon by the handler
+
+
+# Run the frame processing on a worker thread.  The telemetry handler hands
+# over each frame and answers immediately with the latest finished result,
+# so decoding and perception of frame N+1 overlap with the emission of the
+# commands of frame N.  Frames arriving while the worker is busy replace
+# each other in a latest-frame-wins slot instead of queueing up.  A frame
+# whose processing raises is logged and answered with null commands, so
+# the rover stops rather than repeating the controls of an older frame.
+class PipelinedDriver():
+    def __init__(self, process_frame, latency_samples=1024):
+        self.process_frame = process_frame # data -> (commands, pickup, images)
+        self.slot = LatestSlot()
+        self.lock = threading.Lock()
+        self.result = None # Latest finished FrameResult
+        self.received = 0 # Frames received
+        self.processed = 0 # Frames processed
+        self.failed = 0 # Frames whose processing raised
+        self.latencies = deque(maxlen=latency_samples) # Arrival to emission in seconds
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name='pipeline', daemon=True)
+        self.thread.start()
+
+    def submit(self, data):
+        self.received += 1
+        self.slot.put((time.perf_counter(), data))
+
+    def run(self):
+        while self.running:
+            item = self.slot.take(timeout=0.5)
+            if item is None:
+                continue
+            arrival, data = item
+            try:
+                commands, pickup, images = self.process_frame(data)
+                failed = 0
+            except Exception:
+                logger.exception('Frame processing failed')
+                commands, pickup, images = (0, 0, 0), False, ('', '')
+                failed = 1
+            with self.lock:
+                self.result = FrameResult(arrival, commands, pickup, images)
+                self.processed += 1
+                self.failed += failed
+
+    # Latest result, or None before the first frame is processed.
+    # The end-to-end latency is recorded the first time a result is used.
+    def latest(self):
+        with self.lock:
+            result = self.result
+            if result is not None and not result.emitted:
+                result.emitted = True
+                self.latencies.append(time.perf_counter() - result.arrival)
+                return result, True
+        return result, False
+
+    @property
+    def dropped(self):
+        return self.slot.dropped
+
+    def stats(self):
+        if self.latencies:
+            p50, p95 = 1000*np.percentile(self.latencies, [50, 95])
+        else:
+            p50 = p95 = 0.
+        return {'received': self.received, 'processed': self.processed,
+                'failed': self.failed, 'dropped': self.dropped, 'latency_p50': p50, 'latency_p95': p95}
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
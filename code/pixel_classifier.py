@@ -0,0 +1,78 @@
+import numpy as np
+import cv2
+
+# Class label bits stored in the lookup table
+NAVIGABLE = 1
+ROCK = 2
+
+
+# Build a label for every possible RGB colour.  The rules are the same as
+# color_thresh (navigable), and rocks_thresh (HSV yellow range followed by
+# a (5, 5, 5) threshold), evaluated once so that each frame becomes a
+# single table gather.  Colours are labelled one red value at a time, so
+# the temporaries stay at a few hundred KB next to the 16 MB table.
+def build_rgb_lut(nav_thresh=(160, 160, 160), rock_lower=(19, 100, 100),
+                  rock_upper=(29, 255, 255), rock_thresh=(5, 5, 5)):
+    lut = np.zeros(1 << 24, dtype=np.uint8)
+    # Every (green, blue) pair, laid out as an image so cv2 does the HSV conversion
+    green, blue = np.meshgrid(np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), indexing='ij')
+    rgb = np.empty((256, 256, 3), dtype=np.uint8)
+    rgb[:,:,1] = green
+    rgb[:,:,2] = blue
+    green_blue_nav = ((green > nav_thresh[1]) & (blue > nav_thresh[2])).ravel()
+    green_blue_rock = ((green > rock_thresh[1]) & (blue > rock_thresh[2])).ravel()
+    lower = np.array(rock_lower)
+    upper = np.array(rock_upper)
+    for red in range(256):
+        rgb[:,:,0] = red
+        hsv = cv2.cvtColor(rgb, cv2.COLOR_RGB2HSV)
+        labels = lut[red << 16:(red + 1) << 16]
+        if red > nav_thresh[0]:
+            labels[green_blue_nav] = NAVIGABLE
+        if red > rock_thresh[0]:
+            rock = (cv2.inRange(hsv, lower, upper).ravel() > 0) & green_blue_rock
+            labels[rock] |= ROCK
+    return lut
+
+
+# Caller-owned output and scratch buffers for one image shape.
+# The shape may have leading batch dimensions, (N, rows, cols, 3).
+class ClassBuffers():
+    def __init__(self, shape):
+        shape = tuple(shape[:-1])
+        self.shape = shape
+        self.navigable = np.zeros(shape, dtype=np.uint8) # Navigable terrain
+        self.obstacle = np.zeros(shape, dtype=np.uint8) # Visible non-navigable terrain
+        self.rocks = np.zeros(shape, dtype=np.uint8) # Rock samples
+        self.labels = np.zeros(shape, dtype=np.uint8) # Raw class labels
+        self.codes = np.zeros(shape, dtype=np.int32) # Packed RGB colours
+        self.scratch = np.zeros(shape, dtype=np.int32)
+
+
+# Classify navigable, obstacle and rock pixels in one pass over the image
+class PixelClassifier():
+    def __init__(self):
+        self.lut = None # RGB -> label table, built on first use
+
+    def table(self):
+        if self.lut is None:
+            self.lut = build_rgb_lut()
+        return self.lut
+
+    def classify(self, img, mask, buffers):
+        self.table()
+        codes = buffers.codes
+        scratch = buffers.scratch
+        # Pack each pixel into a 24 bit colour code
+        np.left_shift(img[...,0], 16, out=codes, dtype=np.int32)
+        np.left_shift(img[...,1], 8, out=scratch, dtype=np.int32)
+        np.bitwise_or(codes, scratch, out=codes)
+        np.bitwise_or(codes, img[...,2], out=codes, dtype=np.int32)
+        np.take(self.lut, codes, out=buffers.labels)
+        # Split the labels into binary masks
+        np.bitwise_and(buffers.labels, NAVIGABLE, out=buffers.navigable)
+        np.right_shift(buffers.labels, 1, out=buffers.rocks)
+        # Obstacles are the visible pixels that are not navigable
+        np.bitwise_xor(buffers.navigable, 1, out=buffers.obstacle)
+        np.multiply(buffers.obstacle, mask, out=buffers.obstacle)
+        return buffers.navigable, buffers.obstacle, buffers.rocks
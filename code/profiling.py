@@ -0,0 +1,153 @@
+import json
+import logging
+import threading
+import time
+import numpy as np
+
+logger = logging.getLogger('rover')
+
+
+# Timer used while profiling is disabled, does nothing
+class NullTimer():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __call__(self, name):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+# Context manager timing one stage
+class StageTimer():
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter())
+        return False
+
+
+# Times consecutive stages of a function: each call records the time
+# elapsed since the previous call under the given stage name
+class LapTimer():
+    def __init__(self, profiler):
+        self.profiler = profiler
+        self.last = time.perf_counter()
+
+    def __call__(self, name):
+        now = time.perf_counter()
+        self.profiler.record(name, self.last, now)
+        self.last = now
+
+
+# Per-stage latency profiler.  Durations are kept in fixed-size ring buffers
+# so percentiles reflect the most recent frames, and optionally as trace
+# events that can be loaded in chrome://tracing.  When disabled every timer
+# is a shared no-op object.  Stages are recorded from several threads, so
+# the buffers are only touched under the lock.  A profiler collecting in a
+# worker process keeps its records until drain() hands them to the parent
+# profiler, which merges them.
+class StageProfiler():
+    def __init__(self, capacity=1024, report_interval=5):
+        self.enabled = False
+        self.capacity = capacity # Samples kept per stage
+        self.report_interval = report_interval # Seconds between periodic summaries
+        self.buffers = {} # Stage name -> ring buffer of durations in seconds
+        self.counts = {} # Stage name -> number of samples recorded
+        self.trace = None # List of trace events when tracing is enabled
+        self.pending = None # (name, start, end) records not drained yet when collecting
+        self.lock = threading.Lock()
+        self.max_trace_events = 1000000
+        self.origin = time.perf_counter()
+        self.last_report = time.monotonic()
+
+    def enable(self, trace=False, collect=False):
+        self.enabled = True
+        if trace:
+            self.trace = []
+        if collect:
+            self.pending = []
+
+    def stage(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return StageTimer(self, name)
+
+    def laps(self):
+        if not self.enabled:
+            return NULL_TIMER
+        return LapTimer(self)
+
+    def record(self, name, start, end, pid=0):
+        with self.lock:
+            buff = self.buffers.get(name)
+            if buff is None:
+                buff = self.buffers[name] = np.zeros(self.capacity)
+                self.counts[name] = 0
+            buff[self.counts[name] % self.capacity] = end - start
+            self.counts[name] += 1
+            if self.pending is not None:
+                self.pending.append((name, start, end))
+            if self.trace is not None and len(self.trace) < self.max_trace_events:
+                self.trace.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': 0,
+                                   'ts': 1e6*(start - self.origin), 'dur': 1e6*(end - start)})
+
+    # Records since the last call, to send to the parent process
+    def drain(self):
+        with self.lock:
+            if self.pending is None:
+                return []
+            records = self.pending
+            self.pending = []
+        return records
+
+    # Add the records drained from a worker process.  perf_counter is the
+    # system monotonic clock, so worker times line up in the trace.
+    def merge(self, records, pid=0):
+        for name, start, end in records:
+            self.record(name, start, end, pid)
+
+    # Count and p50/p95/p99 latency in milliseconds of every stage
+    def summary(self):
+        with self.lock:
+            samples = {name: (self.counts[name], buff[:min(self.counts[name], self.capacity)].copy())
+                       for name, buff in self.buffers.items()}
+        stats = {}
+        for name, (count, values) in samples.items():
+            p50, p95, p99 = 1000*np.percentile(values, [50, 95, 99])
+            stats[name] = {'count': count, 'p50': p50, 'p95': p95, 'p99': p99}
+        return stats
+
+    def format_summary(self):
+        lines = ['{:<28s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('stage', 'count', 'p50 ms', 'p95 ms', 'p99 ms')]
+        for name, stats in sorted(self.summary().items()):
+            lines.append('{:<28s} {:8d} {:8.3f} {:8.3f} {:8.3f}'.format(
+                name, stats['count'], stats['p50'], stats['p95'], stats['p99']))
+        return '\n'.join(lines)
+
+    # Log the summary if the report interval has elapsed
+    def maybe_report(self):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            logger.info('%s', self.format_summary())
+
+    # Write the recorded events in Chrome trace format
+    def dump_trace(self, path):
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': self.trace or [], 'displayTimeUnit': 'ms'}, trace_file)
+
+
+# Profiler shared by all the pipeline modules
+profiler = StageProfiler()
@@ -0,0 +1,82 @@
+# Replay a recorded telemetry log through the full pipeline without the simulator
+# Example: $ python replay.py run.rlog
+import argparse
+import time
+import numpy as np
+
+from perception import perception_step
+from decision import decision_step
+from supporting_functions import update_rover, create_output_images
+from rover_state import RoverState, RoverConfig
+from telemetry_log import read_telemetry
+from profiling import profiler
+
+STAGES = ('update_rover', 'perception_step', 'decision_step', 'create_output_images')
+
+
+# Run every telemetry frame through the pipeline as fast as possible,
+# returning the per-stage times in seconds, the total wall time and the
+# final Rover state
+def replay(frames, output_images=True, config=RoverConfig()):
+    Rover = RoverState(config)
+    times = {stage: [] for stage in STAGES}
+    start = time.perf_counter()
+    for data in frames:
+        t0 = time.perf_counter()
+        Rover, jpeg = update_rover(Rover, data)
+        t1 = time.perf_counter()
+        times['update_rover'].append(t1 - t0)
+        if not np.isfinite(Rover.vel):
+            continue
+        Rover = perception_step(Rover)
+        t2 = time.perf_counter()
+        Rover = decision_step(Rover)
+        t3 = time.perf_counter()
+        times['perception_step'].append(t2 - t1)
+        times['decision_step'].append(t3 - t2)
+        if output_images:
+            create_output_images(Rover)
+            times['create_output_images'].append(time.perf_counter() - t3)
+    return times, time.perf_counter() - start, Rover
+
+# Format latency percentiles in milliseconds, one line per stage
+def format_report(times, total_time, n_frames):
+    lines = ['{:<22s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('stage', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms')]
+    for stage, values in times.items():
+        if not values:
+            continue
+        p50, p95, p99 = 1000*np.percentile(values, [50, 95, 99])
+        lines.append('{:<22s} {:8.3f} {:8.3f} {:8.3f} {:8.3f}'.format(stage, p50, p95, p99, 1000*max(values)))
+    lines.append('{} frames in {:.2f} s, {:.1f} frames/s'.format(n_frames, total_time, n_frames/total_time))
+    return '\n'.join(lines)
+
+# Format the simulation time spent in each mode and the mode transitions
+def format_modes(Rover):
+    lines = ['{:<12s} {:>8.2f} s'.format(mode, dwell) for mode, dwell in sorted(Rover.mode_dwell.items())]
+    lines += ['{:8.2f} s  {} -> {}'.format(*transition) for transition in Rover.transitions]
+    return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline telemetry replay benchmark')
+    parser.add_argument('log', type=str, help='Telemetry log recorded with drive_rover.py --record.')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of passes over the log.')
+    parser.add_argument('--no_output', action='store_true', help='Skip rendering the output images.')
+    parser.add_argument('--profile', action='store_true', help='Also report the perception sub-stages.')
+    parser.add_argument('--trace', type=str, default='', help='Path of a Chrome trace (JSON) of the replay.')
+    parser.add_argument('--perception', type=str, default='full', choices=['full', 'roi', 'adaptive'],
+                        help='Perception mode, as in drive_rover.py.')
+    parser.add_argument('--frame_budget', type=float, default=5, help='Perception time budget per frame (ms) of --perception adaptive.')
+    args = parser.parse_args()
+    config = RoverConfig(perception_mode=args.perception, frame_budget=args.frame_budget/1000)
+    if args.profile or args.trace != '':
+        profiler.enable(trace=args.trace != '')
+
+    frames = read_telemetry(args.log)
+    for _ in range(args.repeat):
+        times, total_time, Rover = replay(frames, output_images=not args.no_output, config=config)
+        print(format_report(times, total_time, len(frames)))
+    print(format_modes(Rover))
+    if profiler.enabled:
+        print(profiler.format_summary())
+    if args.trace != '':
+        profiler.dump_trace(args.trace)
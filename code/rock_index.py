@@ -0,0 +1,39 @@
+import numpy as np
+
+
+# Grid-bucket hash over the world positions (meters) of the worldmap cells
+# where rocks have been detected.
+# Cells are added incrementally as they are first observed, and a radius
+# query only visits the few buckets overlapping the search circle.
+class RockIndex():
+    def __init__(self, bucket_size=3):
+        self.bucket_size = bucket_size # Bucket side in meters
+        self.buckets = {} # (bucket x, bucket y) -> list of (x, y) cells
+        self.count = 0 # Number of indexed cells
+
+    def add(self, xpix, ypix):
+        size = self.bucket_size
+        for x, y in zip(np.asarray(xpix).tolist(), np.asarray(ypix).tolist()):
+            self.buckets.setdefault((int(x // size), int(y // size)), []).append((x, y))
+        self.count += len(xpix)
+
+    # Check whether a detection lies strictly closer than radius to (x, y)
+    def near(self, x, y, radius):
+        if self.count == 0:
+            return False
+        size = self.bucket_size
+        radius_sq = radius**2
+        for bx in range(int((x - radius) // size), int((x + radius) // size) + 1):
+            for by in range(int((y - radius) // size), int((y + radius) // size) + 1):
+                for cx, cy in self.buckets.get((bx, by), ()):
+                    if (cx - x)**2 + (cy - y)**2 < radius_sq:
+                        return True
+        return False
+
+
+# Flag the known sample positions confirmed by a detection within radius meters
+def located_samples(rock_index, samples_pos, radius=3):
+    if samples_pos is None:
+        return np.zeros(0, dtype=bool)
+    return np.array([rock_index.near(x, y, radius)
+                     for x, y in zip(samples_pos[0], samples_pos[1])], dtype=bool)
@@ -0,0 +1,101 @@
+import numpy as np
+
+from path_planner import astar, octile
+
+
+# Orders the located rock samples left to collect into a route that starts
+# at the rover and ends at the start position.  Legs between samples and
+# home are priced with A* on the current path costs and memoized; a leg is
+# only searched again when a cell within margin of its path changes.  The
+# legs from the rover move with it every frame and use the octile distance.
+# At most max_searches legs are searched per frame, the missing ones are
+# estimated with the octile distance meanwhile.
+class RouteOptimizer():
+    def __init__(self, costs, bounds, max_searches=1, max_expansions=5000, margin=2):
+        self.costs = costs # (x, y) -> cell cost, shared with the PathPlanner
+        self.bounds = bounds # (x0, y0, x1, y1) cells searched
+        self.max_searches = max_searches # A* searches per frame
+        self.max_expansions = max_expansions # Expansion budget of a search
+        self.margin = margin # Cells around a path whose changes invalidate its cost
+        self.memo = {} # (cell, cell) -> (cost, (x0, y0, x1, y1) box around the path)
+        self.collected = set() # Indices of the located samples already collected
+        self.route = [] # Located sample indices in visit order
+        self.searches = 0 # Searches run by the last call to plan()
+
+    # Drop the memoized legs whose path passes near a changed cell
+    def invalidate(self, changed):
+        if not changed or not self.memo:
+            return
+        changed = np.array(changed)
+        for pair, (_, box) in list(self.memo.items()):
+            if box is None:
+                continue
+            x0, y0, x1, y1 = box
+            if np.any((changed[:,0] >= x0) & (changed[:,0] <= x1) & (changed[:,1] >= y0) & (changed[:,1] <= y1)):
+                del self.memo[pair]
+
+    # Path cost between two cells, memoized
+    def leg(self, a, b):
+        pair = (a, b) if a <= b else (b, a)
+        if pair in self.memo:
+            return self.memo[pair][0]
+        if self.searches >= self.max_searches:
+            return octile(a, b)
+        self.searches += 1
+        cost, cells = astar(self.costs, self.bounds, a, b, self.max_expansions)
+        if cells:
+            cells = np.array(cells)
+            box = (cells[:,0].min() - self.margin, cells[:,1].min() - self.margin,
+                   cells[:,0].max() + self.margin, cells[:,1].max() + self.margin)
+            self.memo[pair] = (cost, box)
+        else:
+            # Out of budget, keep the estimate rather than searching every frame
+            cost = octile(a, b)
+            self.memo[pair] = (cost, None)
+        return cost
+
+    # Mark as collected the remaining samples closest to the rover until
+    # collected samples match the simulator count
+    def collect(self, rover_cell, sample_cells, samples_collected):
+        while len(self.collected) < samples_collected:
+            remaining = [idx for idx in range(len(sample_cells)) if idx not in self.collected]
+            if not remaining:
+                break
+            self.collected.add(min(remaining, key=lambda idx: octile(rover_cell, sample_cells[idx])))
+
+    # Visit order of the remaining samples: nearest neighbour from the rover,
+    # improved with 2-opt keeping the rover first and home last
+    def plan(self, rover_cell, sample_cells, home_cell):
+        self.searches = 0
+        remaining = [idx for idx in range(len(sample_cells)) if idx not in self.collected]
+        if not remaining:
+            self.route = []
+            return self.route
+
+        def cost(a, b):
+            if a is None:
+                return octile(rover_cell, sample_cells[b])
+            if b is None:
+                return self.leg(sample_cells[a], home_cell)
+            return self.leg(sample_cells[a], sample_cells[b])
+
+        route = []
+        current = None
+        while remaining:
+            nearest = min(remaining, key=lambda idx: cost(current, idx))
+            remaining.remove(nearest)
+            route.append(nearest)
+            current = nearest
+        # None stands for the rover before the route and home after it
+        improved = True
+        while improved:
+            improved = False
+            for i in range(len(route) - 1):
+                for k in range(i + 1, len(route)):
+                    before = route[i - 1] if i > 0 else None
+                    after = route[k + 1] if k + 1 < len(route) else None
+                    if cost(before, route[k]) + cost(route[i], after) < cost(before, route[i]) + cost(route[k], after) - 1e-9:
+                        route[i:k + 1] = route[i:k + 1][::-1]
+                        improved = True
+        self.route = route
+        return route
@@ -0,0 +1,183 @@
+import os
+from dataclasses import dataclass
+import numpy as np
+import matplotlib.image as mpimg
+
+from occupancy_grid import OccupancyGrid
+from map_metrics import MapMetrics
+from rock_index import RockIndex
+from tiled_map import TiledMap
+from frontier import FrontierPlanner
+from path_planner import PathPlanner, map_bounds
+from route_optimizer import RouteOptimizer
+from adaptive_resolution import ResolutionController
+from perception import PerceptionBuffers
+
+# Read in ground truth map and create 3-channel green version for overplotting
+# NOTE: images are read in by default with the origin (0, 0) in the upper left
+# and y-axis increasing downward.
+ground_truth = mpimg.imread(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                         '..', 'calibration_images', 'map_bw.png'))
+# This next line creates arrays of zeros in the red and blue channels
+# and puts the map into the green channel.  This is why the underlying 
+# map output looks green in the display image
+ground_truth_3d = np.dstack((ground_truth*0, ground_truth*255, ground_truth*0)).astype(float)
+
+# Tuning constants, fixed for a run.
+# map_backend is 'dense' for a fixed 200 x 200 m grid of 1 m cells, or
+# 'tiled' for a sparse map of map_resolution meter cells covering
+# map_extent, which also bounds the path planner searches.  planner is
+# 'frontier' to explore towards the frontiers of the worldmap, or
+# 'reactive' to follow the mean navigable angle.  perception_mode is
+# 'full' to process the whole camera frame, 'roi' to map from the near
+# rows and sample the rest of the view every roi_step pixels, or
+# 'adaptive' to choose the sampling step from frame_budget.
+@dataclass(frozen=True, slots=True)
+class RoverConfig():
+    # Maximum times
+    max_time_stopped: float = 1 # Maximum stopped time in seconds
+    max_time_looping: float = 5 # Maximum looping time in seconds
+    max_time_approaching: float = 0.5 # Maximum approaching time in seconds
+    max_roll: float = 2 # Maximum roll angle to consider valid mapping data
+    max_pitch: float = 2 # Maximum pitch angle to consider valid mapping data
+    brake_set: float = 10 # Brake setting when braking
+    # The stop_forward and go_forward fields below represent total count
+    # of navigable terrain pixels.  This is a very crude form of knowing
+    # when you can keep going and when you should stop.  Feel free to
+    # get creative in adding new fields or modifying these!
+    stop_forward: int = 50 # Threshold to initiate stopping
+    go_forward: int = 500 # Threshold to go forward again
+    max_vel: float = 2.5 # Maximum velocity (meters/second)
+    # Worldmap
+    map_backend: str = 'dense'
+    map_resolution: float = 1.0 # Cell size of the tiled worldmap (meters)
+    map_extent: tuple = (0, 0, 200, 200) # (x, y, width, height) of the tiled worldmap (meters)
+    dst_scale: float = 10 # Top-down image pixels per meter
+    planner: str = 'frontier'
+    home_radius: float = 3 # Distance to the start position at which the run ends (meters)
+    # Perception
+    perception_mode: str = 'full'
+    roi_step: int = 2 # Sampling step of the view in the roi mode (pixels)
+    frame_budget: float = 0.005 # Perception time per frame of the adaptive mode (seconds)
+    angle_tolerance: float = 2 # Maximum error of the sampled navigable angles (degrees)
+    # Forward
+    throttle_set: float = 0.5 # Throttle setting when accelerating
+    deviation: float = 8 # Deviation from navigable angle
+    vel_fwd: float = 3 # Velocity in forward mode [m/s]
+    # Unsticking
+    unstick_angle: float = 25 # Angle to turn when unsticking
+    stuck_steer_angle: float = 15 # Angle to detect looping
+    # Approaching
+    vel_apch: float = 0.5 # Velocity in approaching mode [m/s]
+    throttle_apch: float = 0.2 # Throttle value when approaching to a sample rock
+    # Yaw controller
+    Kp_yaw: float = 0.5 # Yaw controller proportional gain
+    # Velocity controller
+    Kp_vel: float = 0.7 # Velocity controller proportional gain 
+    Ki_vel: float = 0.08 # Velocity controller integral gain
+
+
+# Telemetry and controller fields of RoverState copied by snapshot()
+SNAPSHOT_FIELDS = ('sim_time', 'total_time', 'vel', 'yaw', 'pitch', 'roll', 'steer', 'throttle',
+                   'brake', 'near_sample', 'picking_up', 'send_pickup', 'samples_located',
+                   'samples_collected', 'mode', 'yawref', 'decode_time')
+
+# Define RoverState() class to retain rover state parameters.  Fields are
+# slots, the tuning constants live in the frozen config, and the buffers
+# are allocated once here and then updated in place every frame.
+class RoverState():
+    __slots__ = ('config',
+                 # Telemetry, updated in place by update_rover()
+                 'start_time', 'total_time', 'sim_time', 'frame_dt', 'img', 'decode_time',
+                 'parse_float', 'pos', 'yaw', 'nyaw', 'pitch', 'npitch', 'roll', 'nroll', 'vel',
+                 'steer', 'throttle', 'brake', 'near_sample', 'picking_up',
+                 # Perception
+                 'nav', 'rocks', 'sample_in_sight', 'vision_image', 'resolution', 'perception',
+                 # Mapping and planning
+                 'ground_truth', 'worldmap', 'map_metrics', 'rock_index', 'frontiers',
+                 'path_planner', 'route', 'goal_pos', 'start_pos',
+                 # Samples
+                 'samples_pos', 'samples_pos_detected', 'samples_to_find', 'samples_located',
+                 'prev_samples_located', 'samples_collected', 'send_pickup',
+                 # Modes and controllers
+                 'mode', 'mode_start', 'mode_dwell', 'transitions', 'time_stopped', 'time_looping',
+                 'time_approaching', 'prev_steer', 'yawref', 'int_error_vel')
+
+    def __init__(self, config=RoverConfig()):
+        self.config = config # Tuning constants
+        self.start_time = None # To record the start time of navigation
+        self.total_time = None # To record total duration of naviagation
+        self.sim_time = None # Simulation time of the current frame
+        self.frame_dt = 0 # Simulation time since the previous frame
+        # Intial times
+        self.time_stopped = 0 # Time stoped in foward mode
+        self.time_looping = 0 # Time looping in foward mode
+        self.time_approaching = 0 # Time blocking approaching
+        self.img = None # Current camera image
+        self.decode_time = 0 # Time spent decoding the last camera image in seconds
+        self.parse_float = None # Telemetry number parser for the simulator decimal convention
+        self.pos = [0., 0.] # Current position (x, y)
+        self.yaw = None # Current yaw angle
+        self.nyaw = None # Current yaw angle wrapped to +/- 180
+        self.pitch = None # Current pitch angle
+        self.npitch = None
+        self.roll = None # Current roll angle
+        self.nroll = None
+        self.vel = None # Current velocity
+        self.steer = 0 # Current steering angle
+        self.throttle = 0 # Current throttle value
+        self.brake = 0 # Current brake value
+        self.nav = None # NavSummary of the navigable terrain pixels
+        # Sampling step of the adaptive perception
+        self.resolution = ResolutionController(config.frame_budget, angle_tolerance=config.angle_tolerance) \
+            if config.perception_mode == 'adaptive' else None
+        self.perception = PerceptionBuffers() # Camera model and buffers written by perception
+        self.ground_truth = ground_truth_3d # Ground truth worldmap
+        # Image output from perception step
+        # Update this image to display your intermediate analysis steps
+        # on screen in autonomous mode
+        self.vision_image = np.zeros((160, 320, 3), dtype=np.uint8)
+        # Worldmap
+        # Update this image with the positions of navigable terrain
+        # obstacles and rock samples
+        if config.map_backend == 'tiled':
+            self.worldmap = TiledMap(cell_size=config.map_resolution, extent=config.map_extent)
+        else:
+            self.worldmap = OccupancyGrid(200, 200)
+        self.map_metrics = MapMetrics(ground_truth_3d) # Running map quality statistics
+        self.rock_index = RockIndex() # Spatial index of rock detections in the worldmap
+        self.frontiers = FrontierPlanner() if config.planner == 'frontier' else None # Exploration frontiers
+        self.path_planner = PathPlanner(map_bounds(self.worldmap)) # Paths to located rock samples
+        self.route = RouteOptimizer(self.path_planner.costs, self.path_planner.bounds) # Sample visit order
+        self.goal_pos = None # Position the rover is heading for, a sample or the start
+        self.start_pos = None # Position at the start of the run
+        # Samples
+        self.rocks = None # NavSummary of the rock samples pixels
+        self.samples_pos = None # To store the actual sample positions
+        self.samples_pos_detected = np.zeros((6, 2), dtype=float) # To store detected samples
+        self.samples_to_find = 0 # To store the initial count of samples
+        self.samples_located = 0 # To store number of samples located on map
+        self.prev_samples_located = 0
+        self.samples_collected = 0 # To count the number of samples collected
+        self.near_sample = 0 # Will be set to telemetry value data["near_sample"]
+        self.picking_up = 0 # Will be set to telemetry value data["picking_up"]
+        self.send_pickup = False # Set to True to trigger rock pickup
+        
+        # Modes parameters
+        self.mode = 'forward' # Current mode, a key of decision.MODES
+        self.mode_start = None # Simulation time the current mode was entered
+        self.mode_dwell = {} # Simulation time spent in each mode
+        self.transitions = [] # (simulation time, from mode, to mode) of every transition
+        # Approaching
+        self.sample_in_sight = False # Flag to check if there is a sample rock in sight
+        self.prev_steer = 0 # Previous steer angle
+        # Yaw controller
+        self.yawref = 0 # Yaw reference angle
+        # Velocity controller
+        self.int_error_vel = 0 # Velocity controller integral term
+
+    # Scalar telemetry and controller state, cheap enough to log every frame
+    def snapshot(self):
+        snapshot = {name: getattr(self, name) for name in SNAPSHOT_FIELDS}
+        snapshot['pos'] = tuple(self.pos)
+        return snapshot
@@ -0,0 +1,153 @@
+import json
+import os
+import queue
+import threading
+import time
+import numpy as np
+
+# On-disk layout of a recorded run:
+#   meta.json           frame shape, chunk size, number of frames, extra fields
+#   frames_XXXXX.npy    (chunk_size, rows, cols, 3) uint8 raw camera frames
+#   telemetry_XXXXX.npy (chunk_size,) structured pose/telemetry records
+# Chunks are preallocated .npy files opened as memory maps, so readers get
+# zero-copy random access to any frame.
+META_FILE = 'meta.json'
+
+TELEMETRY_DTYPE = np.dtype([
+    ('timestamp', 'f8'), # Time the frame was received
+    ('x', 'f4'), ('y', 'f4'), # Position
+    ('yaw', 'f4'), ('pitch', 'f4'), ('roll', 'f4'), # Attitude in degrees
+    ('speed', 'f4'), # Velocity in m/s
+    ('near_sample', 'u1'), ('picking_up', 'u1'),
+    ('samples_collected', 'i2'),
+    ('cmd_throttle', 'f4'), ('cmd_brake', 'f4'), ('cmd_steer', 'f4'), # Commands sent back
+    ('cmd_pickup', 'u1'),
+    ])
+
+
+def chunk_path(path, kind, chunk):
+    return os.path.join(path, '{}_{:05d}.npy'.format(kind, chunk))
+
+# Telemetry record of the current Rover state and the commands sent back
+def telemetry_record(Rover, commands, pickup, timestamp=None):
+    record = np.zeros((), dtype=TELEMETRY_DTYPE)
+    record['timestamp'] = time.time() if timestamp is None else timestamp
+    record['x'], record['y'] = Rover.pos[0], Rover.pos[1]
+    record['yaw'], record['pitch'], record['roll'] = Rover.yaw, Rover.pitch, Rover.roll
+    record['speed'] = Rover.vel
+    record['near_sample'], record['picking_up'] = Rover.near_sample, Rover.picking_up
+    record['samples_collected'] = Rover.samples_collected
+    record['cmd_throttle'], record['cmd_brake'], record['cmd_steer'] = commands
+    record['cmd_pickup'] = pickup
+    return record
+
+
+# Append frames and telemetry to a run directory from a background thread.
+# Frames are copied when appended, the disk writes and flushes happen in bulk
+# on the writer thread.
+class RunWriter():
+    def __init__(self, path, frame_shape=(160, 320, 3), chunk_size=1024, flush_every=64, **meta):
+        self.path = path
+        self.frame_shape = tuple(frame_shape)
+        self.chunk_size = chunk_size # Frames per chunk file
+        self.flush_every = flush_every # Frames between flushes to disk
+        self.meta = meta # Extra fields stored in meta.json
+        self.count = 0 # Frames written
+        self.frames = None # Memory map of the current frame chunk
+        self.telemetry = None # Memory map of the current telemetry chunk
+        self.queue = queue.Queue()
+        os.makedirs(path, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name='run_writer', daemon=True)
+        self.thread.start()
+
+    def append(self, frame, record):
+        self.queue.put((np.array(frame, dtype=np.uint8, copy=True), record))
+
+    def update_meta(self, **meta):
+        self.meta.update(meta)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.write(*item)
+            if self.count % self.flush_every == 0:
+                self.flush()
+        self.flush()
+
+    def write(self, frame, record):
+        idx = self.count % self.chunk_size
+        if idx == 0:
+            self.open_chunk(self.count // self.chunk_size)
+        self.frames[idx] = frame
+        self.telemetry[idx] = record
+        self.count += 1
+
+    def open_chunk(self, chunk):
+        self.flush()
+        self.frames = np.lib.format.open_memmap(chunk_path(self.path, 'frames', chunk), mode='w+',
+                                                dtype=np.uint8, shape=(self.chunk_size,) + self.frame_shape)
+        self.telemetry = np.lib.format.open_memmap(chunk_path(self.path, 'telemetry', chunk), mode='w+',
+                                                   dtype=TELEMETRY_DTYPE, shape=(self.chunk_size,))
+
+    def flush(self):
+        if self.frames is not None:
+            self.frames.flush()
+            self.telemetry.flush()
+        meta = dict(self.meta, frame_shape=self.frame_shape, chunk_size=self.chunk_size, count=self.count)
+        with open(os.path.join(self.path, META_FILE + '.tmp'), 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(os.path.join(self.path, META_FILE + '.tmp'), os.path.join(self.path, META_FILE))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+# Read-only, zero-copy access to a recorded run
+class RunReader():
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as meta_file:
+            self.meta = json.load(meta_file)
+        self.count = self.meta['count']
+        self.chunk_size = self.meta['chunk_size']
+        n_chunks = (self.count + self.chunk_size - 1) // self.chunk_size
+        self.frame_chunks = [np.load(chunk_path(path, 'frames', chunk), mmap_mode='r')
+                             for chunk in range(n_chunks)]
+        self.telemetry_chunks = [np.load(chunk_path(path, 'telemetry', chunk), mmap_mode='r')
+                                 for chunk in range(n_chunks)]
+
+    def __len__(self):
+        return self.count
+
+    def locate(self, idx):
+        if idx < 0:
+            idx += self.count
+        if not 0 <= idx < self.count:
+            raise IndexError('frame {} out of range'.format(idx))
+        return divmod(idx, self.chunk_size)
+
+    # Camera frame idx, a view into the memory map
+    def frame(self, idx):
+        chunk, offset = self.locate(idx)
+        return self.frame_chunks[chunk][offset]
+
+    def record(self, idx):
+        chunk, offset = self.locate(idx)
+        return self.telemetry_chunks[chunk][offset]
+
+    def __getitem__(self, idx):
+        return self.frame(idx), self.record(idx)
+
+    # Contiguous frame views of up to chunk_size frames, for batch processing
+    def frame_blocks(self):
+        for chunk, frames in enumerate(self.frame_chunks):
+            yield frames[:min(self.chunk_size, self.count - chunk*self.chunk_size)]
+
+    # All telemetry records of the run as one structured array
+    def telemetry(self):
+        if not self.telemetry_chunks:
+            return np.zeros(0, dtype=TELEMETRY_DTYPE)
+        return np.concatenate(self.telemetry_chunks)[:self.count]
@@ -0,0 +1,109 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from perception import perception_step, classifier
+from decision import decision_step
+from supporting_functions import update_rover
+from inset_encoder import InsetEncoder
+from rover_state import RoverState
+from profiling import profiler
+
+
+# Run one telemetry frame through the perception and decision steps of a
+# rover.  Returns the updated Rover, the JPEG camera frame, the
+# (throttle, brake, steer) commands, whether to send the pickup command
+# instead, and the inset image strings.
+def step_rover(Rover, inset_encoder, data):
+    lap = profiler.laps()
+    # Initialize / update Rover with current telemetry
+    Rover, jpeg = update_rover(Rover, data)
+    lap('decode')
+
+    if np.isfinite(Rover.vel):
+
+        # Execute the perception and decision steps to update the Rover's state
+        Rover = perception_step(Rover)
+        lap('perception')
+        Rover = decision_step(Rover)
+        lap('decision')
+
+        # Output images are rendered on a worker thread, use the latest finished ones
+        out_images = inset_encoder.images()
+        # Start rendering new output images from the current state
+        inset_encoder.update(Rover)
+        lap('output')
+
+        # If in a state where want to pickup a rock send pickup command
+        pickup = Rover.send_pickup and not Rover.picking_up
+        if pickup:
+            # Reset Rover flags
+            Rover.send_pickup = False
+        commands = (Rover.throttle, Rover.brake, Rover.steer)
+
+    # In case of invalid telemetry, send null commands
+    else:
+        print('Data is not received')
+        # Send zeros for throttle, brake and steer and empty images
+        commands, pickup, out_images = (0, 0, 0), False, ('', '')
+    return Rover, jpeg, commands, pickup, out_images
+
+
+# Rovers of the sessions assigned to this worker process, by session id
+worker_sessions = {}
+
+# Build the RGB label table when the worker starts rather than on its
+# first frame.  Forked workers inherit the table of the parent.
+def worker_init():
+    classifier.table()
+
+# Returns the commands, pickup flag, inset images, decode and processing
+# times, and the profiler records of the frame when profiling
+def worker_step(sid, data, config, inset_rate, profile=False):
+    start = time.perf_counter()
+    # A forked worker inherits the profiler of the parent, enabled but not collecting
+    if profile and profiler.pending is None:
+        profiler.enable(collect=True)
+    if sid not in worker_sessions:
+        worker_sessions[sid] = (RoverState(config), InsetEncoder(inset_rate))
+    Rover, inset_encoder = worker_sessions[sid]
+    Rover, jpeg, commands, pickup, out_images = step_rover(Rover, inset_encoder, data)
+    return commands, pickup, out_images, Rover.decode_time, time.perf_counter() - start, profiler.drain()
+
+def worker_close(sid):
+    worker_sessions.pop(sid, None)
+
+
+# Runs the rovers of many simulator sessions on worker processes.  Each
+# worker is a single-process executor so that a session always lands on the
+# same process, where its RoverState lives; new sessions go to the worker
+# with the fewest sessions.  When profiling, the workers time their stages
+# and send the records back with every frame.
+class SessionPool():
+    def __init__(self, workers, config, inset_rate=5, profile=False):
+        self.config = config # RoverConfig of the rovers
+        self.inset_rate = inset_rate
+        self.profile = profile # Collect the stage times of the workers
+        self.executors = [ProcessPoolExecutor(max_workers=1, initializer=worker_init) for _ in range(workers)]
+        self.assigned = {} # Session id -> worker index
+        self.sessions = [0]*workers # Sessions per worker
+
+    # Process a telemetry frame of a session on its worker.  Returns a future
+    # of (commands, pickup, out_images, decode time, processing time, profiler records).
+    def submit(self, sid, data):
+        worker = self.assigned.get(sid)
+        if worker is None:
+            worker = self.assigned[sid] = self.sessions.index(min(self.sessions))
+            self.sessions[worker] += 1
+        return self.executors[worker].submit(worker_step, sid, data, self.config, self.inset_rate, self.profile)
+
+    # Drop the rover of a session that disconnected
+    def close(self, sid):
+        worker = self.assigned.pop(sid, None)
+        if worker is not None:
+            self.sessions[worker] -= 1
+            self.executors[worker].submit(worker_close, sid)
+
+    def shutdown(self):
+        for executor in self.executors:
+            executor.shutdown(cancel_futures=True)
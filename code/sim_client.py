@@ -0,0 +1,236 @@
+# Headless stand-in for the Unity simulator, to drive drive_rover.py in a
+# closed loop without a display
+# Example: $ python sim_client.py --frames 2000 --clients 4
+import argparse
+import base64
+import multiprocessing
+import threading
+import time
+import cv2
+import numpy as np
+
+from rover_state import ground_truth
+from camera_model import CameraModel
+from perception import CAMERA_SOURCE, perspective_destination
+from telemetry_log import read_telemetry
+
+# Colors of the rendered camera frames, RGB
+GROUND_COLOR = (205, 185, 165) # Navigable terrain, above the 160 threshold
+OBSTACLE_COLOR = (110, 85, 70)
+ROCK_COLOR = (200, 170, 20) # Inside the yellow HSV range of the rock detector
+SKY_COLOR = (60, 50, 45)
+
+
+# Ground projection of every camera pixel: the rover-frame position in
+# meters of the ground point seen by each pixel, from the same calibration
+# perception uses.  Pixels above the horizon or beyond max_range see the sky.
+class GroundProjection():
+    def __init__(self, shape=(160, 320, 3), scale=10, max_range=30):
+        rows, cols = shape[:2]
+        camera = CameraModel().calibrate(shape, CAMERA_SOURCE, perspective_destination(shape))
+        v, u = np.mgrid[0:rows, 0:cols].astype(np.float64)
+        M = camera.M
+        w = M[2,0]*u + M[2,1]*v + M[2,2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            xdst = (M[0,0]*u + M[0,1]*v + M[0,2]) / w
+            ydst = (M[1,0]*u + M[1,1]*v + M[1,2]) / w
+        # Top-down pixels to rover coordinates, x forward and y to the left
+        x = -(ydst - rows) / scale
+        y = -(xdst - cols/2) / scale
+        self.shape = (rows, cols)
+        # Ground pixels are on the same side of the horizon as the bottom row
+        below_horizon = np.sign(w) == np.sign(w[-1, cols//2])
+        self.ground = below_horizon & (x > 0) & (np.hypot(x, y) < max_range)
+        self.x = np.float32(x[self.ground]) # Rover-frame coordinates of the ground pixels
+        self.y = np.float32(y[self.ground])
+
+
+# Kinematic rover on the ground truth map.  Navigable map cells are
+# ground, anything else blocks the rover.  Time advances by dt per step, so
+# a run is reproducible whatever the wall-clock rate.
+class HeadlessRover():
+    def __init__(self, start=(99.7, 85.6), yaw=56.8, n_samples=6, dt=1/25, seed=0):
+        self.truth = ground_truth > 0
+        self.x, self.y = start
+        self.yaw = yaw # Degrees, counter-clockwise from the x axis
+        self.vel = 0. # m/s
+        self.throttle = self.brake = self.steer = 0.
+        self.dt = dt # Simulation time step in seconds
+        self.time = 0.
+        self.picking_up = 0. # Remaining pickup time in seconds
+        self.samples_found = 0
+        self.projection = GroundProjection()
+        # Rock samples on random navigable cells away from the start
+        rng = np.random.default_rng(seed)
+        ys, xs = np.nonzero(self.truth)
+        far = np.hypot(xs - start[0], ys - start[1]) > 10
+        pick = rng.choice(np.flatnonzero(far), n_samples, replace=False)
+        self.samples = np.stack((xs[pick] + 0.5, ys[pick] + 0.5), axis=1)
+        self.image = np.zeros(self.projection.shape + (3,), dtype=np.uint8)
+
+    def navigable(self, x, y):
+        rows, cols = self.truth.shape
+        xi = np.int_(x)
+        yi = np.int_(y)
+        inside = (xi >= 0) & (xi < cols) & (yi >= 0) & (yi < rows)
+        return inside & self.truth[np.clip(yi, 0, rows - 1), np.clip(xi, 0, cols - 1)]
+
+    def near_sample(self):
+        if len(self.samples) == 0:
+            return False
+        return np.min(np.hypot(self.samples[:,0] - self.x, self.samples[:,1] - self.y)) < 1
+
+    def command(self, throttle, brake, steer):
+        self.throttle, self.brake, self.steer = throttle, brake, steer
+
+    def pickup(self):
+        if self.near_sample() and abs(self.vel) < 0.2 and not self.picking_up:
+            self.picking_up = 1.
+
+    # Advance the simulation by one time step
+    def step(self):
+        dt = self.dt
+        self.time += dt
+        if self.picking_up:
+            self.picking_up = max(self.picking_up - dt, 0)
+            self.vel = 0.
+            if not self.picking_up:
+                idx = np.argmin(np.hypot(self.samples[:,0] - self.x, self.samples[:,1] - self.y))
+                self.samples = np.delete(self.samples, idx, axis=0)
+                self.samples_found += 1
+            return
+        if self.brake > 0:
+            self.vel = np.sign(self.vel)*max(abs(self.vel) - 2*self.brake*dt, 0)
+        else:
+            self.vel += (4*self.throttle - 0.5*self.vel)*dt
+        if abs(self.vel) < 0.2 and self.throttle == 0 and self.brake == 0:
+            # Four wheel turn in place
+            self.yaw += 2*self.steer*dt
+        else:
+            # Bicycle model with a 1 m wheelbase
+            self.yaw += np.degrees(self.vel*np.tan(np.radians(self.steer)))*dt
+        self.yaw %= 360
+        x = self.x + self.vel*np.cos(np.radians(self.yaw))*dt
+        y = self.y + self.vel*np.sin(np.radians(self.yaw))*dt
+        if self.navigable(x, y):
+            self.x, self.y = x, y
+        else:
+            self.vel = 0.
+
+    # Camera frame seen from the current pose
+    def render(self):
+        projection = self.projection
+        cos_yaw = np.cos(np.radians(self.yaw))
+        sin_yaw = np.sin(np.radians(self.yaw))
+        x_world = self.x + projection.x*cos_yaw - projection.y*sin_yaw
+        y_world = self.y + projection.x*sin_yaw + projection.y*cos_yaw
+        colors = np.where(self.navigable(x_world, y_world)[:,None], GROUND_COLOR, OBSTACLE_COLOR)
+        for sample_x, sample_y in self.samples:
+            colors[(x_world - sample_x)**2 + (y_world - sample_y)**2 < 0.3**2] = ROCK_COLOR
+        self.image[:] = SKY_COLOR
+        self.image[projection.ground] = colors
+        return self.image
+
+    # Telemetry payload in the simulator format
+    def telemetry(self):
+        _, jpeg = cv2.imencode('.jpg', cv2.cvtColor(self.render(), cv2.COLOR_RGB2BGR))
+        samples = self.samples if len(self.samples) else np.zeros((0, 2))
+        return {
+            'speed': '{:.4f}'.format(self.vel),
+            'position': '{:.4f};{:.4f}'.format(self.x, self.y),
+            'yaw': '{:.4f}'.format(self.yaw),
+            'pitch': '0.0000',
+            'roll': '0.0000',
+            'throttle': '{:.4f}'.format(self.throttle),
+            'steering_angle': '{:.4f}'.format(self.steer),
+            'near_sample': str(int(self.near_sample())),
+            'picking_up': str(int(self.picking_up > 0)),
+            'sample_count': str(len(samples)),
+            'samples_x': ';'.join('{:.2f}'.format(x) for x in samples[:,0]),
+            'samples_y': ';'.join('{:.2f}'.format(y) for y in samples[:,1]),
+            'image': base64.b64encode(jpeg).decode('utf-8'),
+            'time': '{:.6f}'.format(self.time),
+            }
+
+
+# Closed-loop socket.io client answering every command with the next
+# telemetry frame, as fast as the server replies unless realtime is set.
+# Frames come from the headless rover, or are played back from a log.
+def run_client(url, frames, realtime=False, log=None, seed=0):
+    # The socket.io client needs the python-socketio client extras, the
+    # headless rover itself does not
+    import socketio
+    rover = None if log is not None else HeadlessRover(seed=seed)
+    playback = read_telemetry(log) if log is not None else None
+    client = socketio.Client()
+    done = threading.Event()
+    latencies = []
+    state = {'sent': 0, 'emitted': None, 'start': None}
+
+    def emit_next():
+        if state['sent'] >= frames:
+            done.set()
+            return
+        if rover is not None:
+            rover.step()
+            data = rover.telemetry()
+            if realtime:
+                time.sleep(max(state['start'] + rover.time - time.perf_counter(), 0))
+        else:
+            data = playback[state['sent'] % len(playback)]
+        state['emitted'] = time.perf_counter()
+        state['sent'] += 1
+        client.emit('telemetry', data)
+
+    def reply():
+        now = time.perf_counter()
+        if state['start'] is None:
+            state['start'] = now
+        elif state['emitted'] is not None:
+            latencies.append(now - state['emitted'])
+        emit_next()
+
+    @client.on('data')
+    def on_data(data):
+        if rover is not None:
+            rover.command(float(data['throttle']), float(data['brake']), float(data['steering_angle']))
+        reply()
+
+    @client.on('pickup')
+    def on_pickup(data):
+        if rover is not None:
+            rover.pickup()
+        reply()
+
+    client.connect(url)
+    done.wait()
+    elapsed = time.perf_counter() - state['start']
+    client.disconnect()
+    report = {'frames': state['sent'], 'elapsed': elapsed, 'rate': state['sent']/elapsed,
+              'latency_p50': 1000*np.percentile(latencies, 50), 'latency_p95': 1000*np.percentile(latencies, 95)}
+    if rover is not None:
+        report.update(sim_time=rover.time, samples_found=rover.samples_found, position=(rover.x, rover.y))
+    return report
+
+def run_client_args(client_args):
+    return run_client(*client_args)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Headless simulator for closed-loop load tests of drive_rover.py')
+    parser.add_argument('--url', type=str, default='http://localhost:4567', help='Address of drive_rover.py.')
+    parser.add_argument('--frames', type=int, default=1000, help='Telemetry frames sent by each client.')
+    parser.add_argument('--clients', type=int, default=1, help='Simulators connected at once, one process each.')
+    parser.add_argument('--realtime', action='store_true', help='Pace frames at the simulation rate instead of as fast as possible.')
+    parser.add_argument('--log', type=str, default=None, help='Play back the frames of a telemetry log instead of rendering them.')
+    args = parser.parse_args()
+
+    client_args = [(args.url, args.frames, args.realtime, args.log, seed) for seed in range(args.clients)]
+    with multiprocessing.Pool(args.clients) as pool:
+        reports = pool.map(run_client_args, client_args)
+    for idx, report in enumerate(reports):
+        print('client {}: {frames} frames in {elapsed:.2f} s, {rate:.1f} frames/s, '
+              'latency p50 {latency_p50:.1f} ms p95 {latency_p95:.1f} ms'.format(idx, **report))
+        if 'sim_time' in report:
+            print('  simulated {sim_time:.1f} s, {samples_found} samples collected, '
+                  'final position ({position[0]:.1f}, {position[1]:.1f})'.format(**report))
+    print('total: {:.1f} frames/s'.format(sum(report['rate'] for report in reports)))
@@ -4,6 +4,11 @@ from PIL import Image
 from io import BytesIO, StringIO
 import base64
 import time
+import logging
+from occupancy_grid import OBSTACLE, NAVIGABLE
+from rock_index import located_samples
+
+logger = logging.getLogger('rover')
 
 # Wrap angle between +-180deg
 def wrap_angle_180(angle):
@@ -24,131 +29,174 @@ def wrap_angle_360(angle):
 # Define a function to convert telemetry strings to float independent of decimal convention
 def convert_to_float(string_to_convert):
       if ',' in string_to_convert:
-            float_value = np.float(string_to_convert.replace(',','.'))
+            float_value = float(string_to_convert.replace(',','.'))
       else: 
-            float_value = np.float(string_to_convert)
+            float_value = float(string_to_convert)
       return float_value
 
+# Numeric telemetry fields used to detect the decimal convention
+float_fields = ('speed', 'position', 'yaw', 'pitch', 'roll', 'throttle', 'steering_angle')
+
+# Pick a float parser for the decimal convention used by the simulator locale.
+# Returns None while the fields seen so far contain no decimal separator.
+def detect_float_parser(data):
+      fields = [data[key] for key in float_fields if key in data]
+      if any(',' in field for field in fields):
+            return lambda string_to_convert: float(string_to_convert.replace(',','.'))
+      if any('.' in field for field in fields):
+            return float
+      return None
+
+# Decode the base64 JPEG camera frame straight to an RGB array,
+# writing into out when a buffer of the right shape is given
+def decode_image(img_string, out=None):
+      jpeg = np.frombuffer(base64.b64decode(img_string), dtype=np.uint8)
+      bgr = cv2.imdecode(jpeg, cv2.IMREAD_COLOR)
+      if out is None or out.shape != bgr.shape:
+            out = None
+      return cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=out), jpeg
+
+# Simulation time of a telemetry frame in seconds: the 'time' field, stamped
+# with the receive time by drive_rover.py when the simulator does not send it
+def frame_time(data):
+      if 'time' in data:
+            return convert_to_float(data['time'])
+      return time.time()
+
 def update_rover(Rover, data):
+      # Timers run on simulation time so that decisions do not depend on the frame rate
+      now = frame_time(data)
+      Rover.frame_dt = 0 if Rover.sim_time is None else max(now - Rover.sim_time, 0)
+      Rover.sim_time = now
       # Initialize start time and sample positions
       if Rover.start_time == None:
-            Rover.start_time = time.time()
+            Rover.start_time = now
             Rover.total_time = 0
             samples_xpos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_x"].split(';')])
             samples_ypos = np.int_([convert_to_float(pos.strip()) for pos in data["samples_y"].split(';')])
             Rover.samples_pos = (samples_xpos, samples_ypos)
-            Rover.samples_to_find = np.int(data["sample_count"])
+            Rover.samples_to_find = int(data["sample_count"])
       # Or just update elapsed time
       else:
-            tot_time = time.time() - Rover.start_time
+            tot_time = now - Rover.start_time
             if np.isfinite(tot_time):
                   Rover.total_time = tot_time
+      # The decimal convention is detected once, then parsed without checks
+      if Rover.parse_float is None:
+            Rover.parse_float = detect_float_parser(data)
+      to_float = Rover.parse_float or convert_to_float
       # Print out the fields in the telemetry data dictionary
-      print(data.keys())
+      if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', data.keys())
       # The current speed of the rover in m/s
-      Rover.vel = convert_to_float(data["speed"])
-      # The current position of the rover
-      Rover.pos = [convert_to_float(pos.strip()) for pos in data["position"].split(';')]
+      Rover.vel = to_float(data["speed"])
+      # The current position of the rover, updated in place rather than rebuilt every frame
+      xpos, ypos = data["position"].split(';')
+      pos = Rover.pos
+      pos[0] = to_float(xpos)
+      pos[1] = to_float(ypos)
+      if Rover.start_pos is None:
+            Rover.start_pos = list(pos)
       # The current yaw angle of the rover
-      Rover.yaw = convert_to_float(data["yaw"])
+      Rover.yaw = to_float(data["yaw"])
       Rover.nyaw = wrap_angle_180(Rover.yaw)
       # The current yaw angle of the rover
-      Rover.pitch = convert_to_float(data["pitch"])
+      Rover.pitch = to_float(data["pitch"])
       Rover.npitch = wrap_angle_180(Rover.pitch)
       # The current yaw angle of the rover
-      Rover.roll = convert_to_float(data["roll"])
+      Rover.roll = to_float(data["roll"])
       Rover.nroll = wrap_angle_180(Rover.roll)
       # The current throttle setting
-      Rover.throttle = convert_to_float(data["throttle"])
+      Rover.throttle = to_float(data["throttle"])
       # The current steering angle
-      Rover.steer = convert_to_float(data["steering_angle"])
+      Rover.steer = to_float(data["steering_angle"])
       # Near sample flag
-      Rover.near_sample = np.int(data["near_sample"])
+      Rover.near_sample = int(data["near_sample"])
       # Picking up flag
-      Rover.picking_up = np.int(data["picking_up"])
+      Rover.picking_up = int(data["picking_up"])
       # Update number of rocks collected
-      Rover.samples_collected = Rover.samples_to_find - np.int(data["sample_count"])
+      Rover.samples_collected = Rover.samples_to_find - int(data["sample_count"])
 
-      print('yawref',Rover.yawref,'mode',Rover.mode,'speed =',Rover.vel, 'position =', Rover.pos, 'throttle =', 
-      Rover.throttle, 'steer_angle =', Rover.steer, 'near_sample:', Rover.near_sample, 
-      'picking_up:', data["picking_up"], 'sending pickup:', Rover.send_pickup, 
-      'total time:', Rover.total_time, 'samples remaining:', data["sample_count"], 
-      'samples collected:', Rover.samples_collected)
+      # Get the current image from the center camera of the rover,
+      # reusing the previous frame buffer
+      start = time.perf_counter()
+      Rover.img, jpeg = decode_image(data["image"], Rover.img)
+      Rover.decode_time = time.perf_counter() - start
 
-      # Get the current image from the center camera of the rover
-      imgString = data["image"]
-      image = Image.open(BytesIO(base64.b64decode(imgString)))
-      Rover.img = np.asarray(image)
+      if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', Rover.snapshot())
 
-      # Return updated Rover and separate image for optional saving
-      return Rover, image
+      # Return updated Rover and the encoded JPEG frame for optional saving
+      return Rover, jpeg
+
+# Capture everything needed to render the output images, so that rendering
+# can run later, or on another thread, without touching the live Rover state
+def snapshot_output_data(Rover):
+      worldmap = Rover.worldmap
+      confirmed = located_samples(Rover.rock_index, Rover.samples_pos)
+      # The map layers are resampled to the ground truth grid the display is drawn at
+      inset_shape = Rover.ground_truth.shape[:2]
+      return {
+            'navigable': worldmap.inset(NAVIGABLE, inset_shape),
+            'navigable_mean': worldmap.mean(NAVIGABLE),
+            'obstacle': worldmap.inset(OBSTACLE, inset_shape),
+            'obstacle_mean': worldmap.mean(OBSTACLE),
+            'ground_truth': Rover.ground_truth,
+            'samples_located': [(Rover.samples_pos[0][idx], Rover.samples_pos[1][idx])
+                                for idx in np.flatnonzero(confirmed)],
+            'perc_mapped': Rover.map_metrics.perc_mapped(),
+            'fidelity': Rover.map_metrics.fidelity(),
+            'total_time': Rover.total_time,
+            'samples_collected': Rover.samples_collected,
+            'vision_image': Rover.vision_image.copy(),
+            }
 
 # Define a function to create display output given worldmap results
 def create_output_images(Rover):
+      return render_output_images(snapshot_output_data(Rover))
+
+# Render and encode the output images from a snapshot of the Rover state
+def render_output_images(snapshot):
 
       # Create a scaled map for plotting and clean up obs/nav pixels a bit
-      if np.max(Rover.worldmap[:,:,2]) > 0:
-            nav_pix = Rover.worldmap[:,:,2] > 0
-            navigable = Rover.worldmap[:,:,2] * (255 / np.mean(Rover.worldmap[nav_pix, 2]))
+      # The mean of the observed cells is tracked by the map, no full scan needed
+      if snapshot['navigable_mean'] > 0:
+            navigable = snapshot['navigable'] * (255 / snapshot['navigable_mean'])
       else: 
-            navigable = Rover.worldmap[:,:,2]
-      if np.max(Rover.worldmap[:,:,0]) > 0:
-            obs_pix = Rover.worldmap[:,:,0] > 0
-            obstacle = Rover.worldmap[:,:,0] * (255 / np.mean(Rover.worldmap[obs_pix, 0]))
+            navigable = snapshot['navigable'].astype(float)
+      if snapshot['obstacle_mean'] > 0:
+            obstacle = snapshot['obstacle'] * (255 / snapshot['obstacle_mean'])
       else:
-            obstacle = Rover.worldmap[:,:,0]
+            obstacle = snapshot['obstacle'].astype(float)
 
+      # Maps of another resolution are resampled to the ground truth grid
+      truth_shape = snapshot['ground_truth'].shape[:2]
+      if navigable.shape != truth_shape:
+            navigable = cv2.resize(navigable, truth_shape[::-1], interpolation=cv2.INTER_AREA)
+            obstacle = cv2.resize(obstacle, truth_shape[::-1], interpolation=cv2.INTER_AREA)
       likely_nav = navigable >= obstacle
       obstacle[likely_nav] = 0
-      plotmap = np.zeros_like(Rover.worldmap)
+      plotmap = np.zeros(navigable.shape + (3,), dtype=float)
       plotmap[:, :, 0] = obstacle
       plotmap[:, :, 2] = navigable
       plotmap = plotmap.clip(0, 255)
       # Overlay obstacle and navigable terrain map with ground truth map
-      map_add = cv2.addWeighted(plotmap, 1, Rover.ground_truth, 0.5, 0)
-
-      # Check whether any rock detections are present in worldmap
-      rock_world_pos = Rover.worldmap[:,:,1].nonzero()
-      # If there are, we'll step through the known sample positions
-      # to confirm whether detections are real
-      samples_located = 0
-      if rock_world_pos[0].any():
-            
-            rock_size = 2
-            for idx in range(len(Rover.samples_pos[0])):
-                  test_rock_x = Rover.samples_pos[0][idx]
-                  test_rock_y = Rover.samples_pos[1][idx]
-                  rock_sample_dists = np.sqrt((test_rock_x - rock_world_pos[1])**2 + \
-                                        (test_rock_y - rock_world_pos[0])**2)
-                  # If rocks were detected within 3 meters of known sample positions
-                  # consider it a success and plot the location of the known
-                  # sample on the map
-                  if np.min(rock_sample_dists) < 3:
-                        samples_located += 1
-                        map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
-                        test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
-
-      # Calculate some statistics on the map results
-      # First get the total number of pixels in the navigable terrain map
-      tot_nav_pix = np.float(len((plotmap[:,:,2].nonzero()[0])))
-      # Next figure out how many of those correspond to ground truth pixels
-      good_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] > 0)).nonzero()[0]))
-      # Next find how many do not correspond to ground truth pixels
-      bad_nav_pix = np.float(len(((plotmap[:,:,2] > 0) & (Rover.ground_truth[:,:,1] == 0)).nonzero()[0]))
-      # Grab the total number of map pixels
-      tot_map_pix = np.float(len((Rover.ground_truth[:,:,1].nonzero()[0])))
-      # Calculate the percentage of ground truth map that has been successfully found
-      perc_mapped = round(100*good_nav_pix/tot_map_pix, 1)
-      # Calculate the number of good map pixel detections divided by total pixels 
-      # found to be navigable terrain
-      if tot_nav_pix > 0:
-            fidelity = round(100*good_nav_pix/(tot_nav_pix), 1)
-      else:
-            fidelity = 0
+      map_add = cv2.addWeighted(plotmap, 1, snapshot['ground_truth'], 0.5, 0)
+
+      # Plot the known samples confirmed by rock detections
+      samples_located = len(snapshot['samples_located'])
+      rock_size = 2
+      for test_rock_x, test_rock_y in snapshot['samples_located']:
+            map_add[test_rock_y-rock_size:test_rock_y+rock_size, 
+            test_rock_x-rock_size:test_rock_x+rock_size, :] = 255
+
+      # Map statistics are updated incrementally as new cells are observed
+      perc_mapped = snapshot['perc_mapped']
+      fidelity = snapshot['fidelity']
       # Flip the map for plotting so that the y-axis points upward in the display
       map_add = np.flipud(map_add).astype(np.float32)
       # Add some text about map and rock sample detection results
-      cv2.putText(map_add,"Time: "+str(np.round(Rover.total_time, 1))+' s', (0, 10), 
+      cv2.putText(map_add,"Time: "+str(np.round(snapshot['total_time'], 1))+' s', (0, 10), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       cv2.putText(map_add,"Mapped: "+str(perc_mapped)+'%', (0, 25), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
@@ -158,7 +206,7 @@ def create_output_images(Rover):
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       cv2.putText(map_add,"  Located: "+str(samples_located), (0, 70), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
-      cv2.putText(map_add,"  Collected: "+str(Rover.samples_collected), (0, 85), 
+      cv2.putText(map_add,"  Collected: "+str(snapshot['samples_collected']), (0, 85), 
                   cv2.FONT_HERSHEY_COMPLEX, 0.4, (255, 255, 255), 1)
       # Convert map and vision image to base64 strings for sending to server
       pil_img = Image.fromarray(map_add.astype(np.uint8))
@@ -166,7 +214,7 @@ def create_output_images(Rover):
       pil_img.save(buff, format="JPEG")
       encoded_string1 = base64.b64encode(buff.getvalue()).decode("utf-8")
       
-      pil_img = Image.fromarray(Rover.vision_image.astype(np.uint8))
+      pil_img = Image.fromarray(snapshot['vision_image'])
       buff = BytesIO()
       pil_img.save(buff, format="JPEG")
       encoded_string2 = base64.b64encode(buff.getvalue()).decode("utf-8")
@@ -0,0 +1,74 @@
+import base64
+import pickle
+import struct
+import time
+
+# Binary log of a driving session: a header followed by records made of a
+# small fixed header (kind, timestamp, payload length) and a pickled payload.
+# Camera frames are stored as raw JPEG bytes rather than base64 text.
+LOG_MAGIC = b'RVRLOG1\n'
+RECORD_HEADER = struct.Struct('<BdI')
+
+# Record kinds
+TELEMETRY = 0 # Telemetry dict received from the simulator
+CONTROL = 1 # Throttle, brake and steer command sent back
+PICKUP = 2 # Pickup command sent back
+
+
+# Write telemetry and the commands emitted in response to a log file
+class TelemetryRecorder():
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.file.write(LOG_MAGIC)
+        self.records = 0 # Number of records written
+
+    def write(self, kind, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.write(RECORD_HEADER.pack(kind, timestamp, len(data)))
+        self.file.write(data)
+        self.records += 1
+
+    def write_telemetry(self, data, timestamp=None):
+        record = dict(data)
+        if 'image' in record:
+            record['image'] = base64.b64decode(record['image'])
+        self.write(TELEMETRY, record, timestamp)
+
+    def write_control(self, commands, timestamp=None):
+        throttle, brake, steer = commands
+        self.write(CONTROL, {'throttle': float(throttle), 'brake': float(brake),
+                             'steering_angle': float(steer)}, timestamp)
+
+    def write_pickup(self, timestamp=None):
+        self.write(PICKUP, {}, timestamp)
+
+    def close(self):
+        self.file.close()
+
+
+# Iterate over the (kind, timestamp, payload) records of a log file.
+# Telemetry images are returned base64 encoded, exactly as received.
+def read_log(path):
+    with open(path, 'rb') as log_file:
+        if log_file.read(len(LOG_MAGIC)) != LOG_MAGIC:
+            raise ValueError('{} is not a telemetry log'.format(path))
+        while True:
+            header = log_file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            kind, timestamp, length = RECORD_HEADER.unpack(header)
+            data = log_file.read(length)
+            if len(data) < length:
+                # Truncated last record, the recording was interrupted
+                return
+            payload = pickle.loads(data)
+            if kind == TELEMETRY and 'image' in payload:
+                payload['image'] = base64.b64encode(payload['image']).decode('utf-8')
+            yield kind, timestamp, payload
+
+# Telemetry dicts of a log file, in order
+def read_telemetry(path):
+    return [payload for kind, timestamp, payload in read_log(path) if kind == TELEMETRY]
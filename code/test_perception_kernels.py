@@ -0,0 +1,162 @@
+# Checks of the fused perception kernel against the NumPy path.  The
+# kernel runs interpreted, and compiled when numba is installed; both must
+# give the NumPy vision image, navigation summaries and mapped cells, and
+# build the same worldmap over a run of frames, recorded in a telemetry log
+# or else driven in closed loop on the headless simulator.
+# Example: $ python test_perception_kernels.py --log run.rlog
+import argparse
+import glob
+import os
+import sys
+import unittest
+from unittest import mock
+import numpy as np
+import matplotlib.image as mpimg
+
+import perception
+from perception_kernels import KERNELS, perceive_pixels
+from rover_state import RoverState
+from decision import decision_step
+from sim_client import HeadlessRover
+from supporting_functions import update_rover
+from telemetry_log import read_telemetry
+from profiling import NULL_TIMER
+from occupancy_grid import NAVIGABLE
+
+CALIBRATION_IMAGES = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                   '..', 'calibration_images', '*.jpg')))
+# Telemetry log recorded with drive_rover.py --record, the frames are
+# simulated without one
+LOG = os.environ.get('ROVER_LOG', '')
+# Frames to check, the interpreted kernel takes a while per frame
+LOG_FRAMES = 50
+# Seed of the headless simulator run
+SIM_SEED = 0
+# The kernel as plain Python, and compiled when numba is installed
+INTERPRETED = getattr(perceive_pixels, 'py_func', perceive_pixels)
+COMPILED = perceive_pixels if KERNELS else None
+
+
+# Run perception with the given kernel, or with the NumPy path for None
+def with_kernel(kernel):
+    patches = [mock.patch.object(perception, 'use_kernels', kernel is not None)]
+    if kernel is not None:
+        patches.append(mock.patch.object(perception, 'perceive_pixels', kernel))
+    return patches
+
+# Full frame perception of an image at a pose.  Returns the vision image,
+# the navigable and rock sector histograms and weight totals, and the
+# mapped worldmap cells.
+def perceive(img, pos, yaw, kernel):
+    Rover = RoverState()
+    Rover.img = img
+    Rover.pos = list(pos)
+    Rover.yaw = yaw
+    worldmap = Rover.worldmap
+    patches = with_kernel(kernel)
+    for patch in patches:
+        patch.start()
+    try:
+        if kernel is not None:
+            threshed, world = perception.perceive_fused(Rover, True, NULL_TIMER)
+            cells = [worldmap.world_to_cells(x, y) for x, y in world]
+        else:
+            threshed, crops = perception.perceive_full(Rover, NULL_TIMER)
+            cells = [perception.pix_to_cells(x, y, pos[0], pos[1], yaw, Rover.config.dst_scale, worldmap)
+                     for x, y in crops]
+    finally:
+        for patch in patches:
+            patch.stop()
+    return {'vision': Rover.vision_image, 'cells': np.concatenate([np.concatenate(xy) for xy in cells]),
+            'nav_histogram': Rover.nav.histogram, 'rock_histogram': Rover.rocks.histogram,
+            'nav_sums': Rover.nav.sums, 'rock_sums': Rover.rocks.sums}
+
+# Telemetry frames of the headless simulator driven in closed loop by the
+# perception and decision steps, deterministic for a seed
+def simulated_frames(n_frames, seed=0):
+    sim = HeadlessRover(seed=seed)
+    Rover = RoverState()
+    frames = []
+    for _ in range(n_frames):
+        data = sim.telemetry()
+        frames.append(data)
+        Rover, _ = update_rover(Rover, data)
+        if np.isfinite(Rover.vel):
+            perception.perception_step(Rover)
+            decision_step(Rover)
+        if Rover.send_pickup and not Rover.picking_up:
+            Rover.send_pickup = False
+            sim.pickup()
+        else:
+            sim.command(float(Rover.throttle), float(Rover.brake), float(Rover.steer))
+        sim.step()
+    return frames
+
+# Run perception_step over recorded telemetry frames.  Returns the rover.
+def perceive_frames(frames, kernel):
+    Rover = RoverState()
+    patches = with_kernel(kernel)
+    for patch in patches:
+        patch.start()
+    try:
+        for data in frames:
+            Rover, _ = update_rover(Rover, data)
+            if np.isfinite(Rover.vel):
+                perception.perception_step(Rover)
+    finally:
+        for patch in patches:
+            patch.stop()
+    return Rover
+
+
+class PerceptionKernelTest(unittest.TestCase):
+    def check_images(self, kernel):
+        rng = np.random.default_rng(0)
+        for path in CALIBRATION_IMAGES:
+            img = np.uint8(mpimg.imread(path))
+            for _ in range(3):
+                pos, yaw = rng.uniform(20, 180, 2), rng.uniform(0, 360)
+                expected = perceive(img, pos, yaw, None)
+                outputs = perceive(img, pos, yaw, kernel)
+                with self.subTest(image=os.path.basename(path), pos=pos, yaw=yaw):
+                    for name in ('vision', 'cells', 'nav_histogram', 'rock_histogram'):
+                        np.testing.assert_array_equal(outputs[name], expected[name], err_msg=name)
+                    # Weight totals are summed in another order by the NumPy path
+                    for name in ('nav_sums', 'rock_sums'):
+                        np.testing.assert_allclose(outputs[name], expected[name], rtol=1e-5, err_msg=name)
+
+    def check_frames(self, kernel):
+        if LOG == '':
+            frames = simulated_frames(LOG_FRAMES, SIM_SEED)
+        else:
+            frames = read_telemetry(LOG)[:LOG_FRAMES]
+        expected = perceive_frames(frames, None)
+        rover = perceive_frames(frames, kernel)
+        self.assertTrue(expected.worldmap.any(NAVIGABLE))
+        np.testing.assert_array_equal(rover.worldmap.data, expected.worldmap.data)
+        np.testing.assert_array_equal(rover.vision_image, expected.vision_image)
+        self.assertEqual(rover.samples_located, expected.samples_located)
+
+    def test_interpreted_images(self):
+        self.check_images(INTERPRETED)
+
+    @unittest.skipIf(COMPILED is None, 'numba not installed')
+    def test_compiled_images(self):
+        self.check_images(COMPILED)
+
+    def test_interpreted_frames(self):
+        self.check_frames(INTERPRETED)
+
+    @unittest.skipIf(COMPILED is None, 'numba not installed')
+    def test_compiled_frames(self):
+        self.check_frames(COMPILED)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the fused perception kernel')
+    parser.add_argument('--log', type=str, default=LOG, help='Telemetry log of the recorded frames to check.')
+    parser.add_argument('--log_frames', type=int, default=LOG_FRAMES, help='Frames of the log or of the simulated run to check.')
+    args, unittest_args = parser.parse_known_args()
+    LOG = args.log
+    LOG_FRAMES = args.log_frames
+    unittest.main(argv=sys.argv[:1] + unittest_args)
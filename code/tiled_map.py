@@ -0,0 +1,174 @@
+import numpy as np
+
+# Offset applied to cell coordinates when packing them into one int64 key
+KEY_OFFSET = 1 << 30
+
+
+# Sparse world map made of square tiles allocated lazily as the rover
+# explores.  Cells have a configurable size in meters and any coordinate is
+# valid, nothing is clipped to the map border.  It offers the same interface
+# as OccupancyGrid, with memory growing with the explored area.
+class TiledMap():
+    def __init__(self, cell_size=1.0, tile_size=64, layers=3, extent=(0, 0, 200, 200), dtype=np.uint16):
+        self.cell_size = cell_size # Cell side in meters
+        self.tile_size = tile_size # Tile side in cells
+        self.layers = layers
+        self.extent = extent # (x, y, width, height) in meters rendered by layer()
+        self.dtype = dtype
+        self.max_count = np.iinfo(dtype).max # Counts saturate at this value
+        self.tiles = {} # (tile y, tile x) -> (layers, tile_size, tile_size) counts
+        self.nonzero_count = np.zeros(layers, dtype=np.int64) # Observed cells per layer
+        self.total = np.zeros(layers, dtype=np.int64) # Sum of counts per layer
+
+    # World coordinates in meters to cell coordinates
+    def world_to_cells(self, x_world, y_world):
+        return (np.floor(np.asarray(x_world) / self.cell_size).astype(np.int64),
+                np.floor(np.asarray(y_world) / self.cell_size).astype(np.int64))
+
+    # Cell coordinates packed into a single key, and back
+    def pack(self, xpix, ypix):
+        return ((np.asarray(ypix, dtype=np.int64) + KEY_OFFSET) << 32) | (np.asarray(xpix, dtype=np.int64) + KEY_OFFSET)
+
+    def unravel(self, cells):
+        return (cells & 0xffffffff) - KEY_OFFSET, (cells >> 32) - KEY_OFFSET
+
+    def tile(self, key):
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.tiles[key] = np.zeros((self.layers, self.tile_size, self.tile_size), dtype=self.dtype)
+        return tile
+
+    # Add one hit per (y, x) cell, duplicates within a call all count.
+    # Returns the packed keys of the cells observed for the first time.
+    def add(self, ypix, xpix, layer):
+        if len(ypix) == 0:
+            return np.zeros(0, dtype=np.int64)
+        cells, hits = np.unique(self.pack(xpix, ypix), return_counts=True)
+        return self.add_counts(cells, hits, layer)
+
+    def add_counts(self, cells, hits, layer):
+        xpix, ypix = self.unravel(cells)
+        size = self.tile_size
+        tile_y = ypix // size
+        tile_x = xpix // size
+        new_cells = []
+        # Update the cells tile by tile, allocating tiles on first use
+        tile_keys, inverse = np.unique(np.stack((tile_y, tile_x), axis=1), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        for idx, (ty, tx) in enumerate(tile_keys.tolist()):
+            sel = inverse == idx
+            counts = self.tile((ty, tx))[layer]
+            local_y = ypix[sel] - ty*size
+            local_x = xpix[sel] - tx*size
+            old = counts[local_y, local_x].astype(np.int64)
+            new = np.minimum(old + hits[sel], self.max_count)
+            counts[local_y, local_x] = new
+            self.total[layer] += np.sum(new - old)
+            new_cells.append(cells[sel][old == 0])
+        new_cells = np.concatenate(new_cells)
+        self.nonzero_count[layer] += len(new_cells)
+        return new_cells
+
+    # Counts of the given cells, zero where no tile is allocated
+    def values(self, layer, ypix, xpix):
+        ypix = np.asarray(ypix, dtype=np.int64)
+        xpix = np.asarray(xpix, dtype=np.int64)
+        out = np.zeros(ypix.shape, dtype=self.dtype)
+        size = self.tile_size
+        tile_y = ypix // size
+        tile_x = xpix // size
+        for ty, tx in set(zip(tile_y.ravel().tolist(), tile_x.ravel().tolist())):
+            tile = self.tiles.get((ty, tx))
+            if tile is None:
+                continue
+            sel = (tile_y == ty) & (tile_x == tx)
+            out[sel] = tile[layer][ypix[sel] - ty*size, xpix[sel] - tx*size]
+        return out
+
+    def mean(self, layer):
+        if self.nonzero_count[layer] == 0:
+            return 0.
+        return self.total[layer] / self.nonzero_count[layer]
+
+    def any(self, layer):
+        return self.nonzero_count[layer] > 0
+
+    # Dense counts of a layer over the display extent, built from the
+    # allocated tiles overlapping it only
+    def layer(self, layer):
+        x0, y0 = [int(cell) for cell in self.world_to_cells(self.extent[0], self.extent[1])]
+        cols = int(np.ceil(self.extent[2] / self.cell_size))
+        rows = int(np.ceil(self.extent[3] / self.cell_size))
+        out = np.zeros((rows, cols), dtype=self.dtype)
+        size = self.tile_size
+        for (ty, tx), tile in self.tiles.items():
+            # Overlap of the tile with the window, in window coordinates
+            r0 = max(ty*size - y0, 0)
+            r1 = min((ty + 1)*size - y0, rows)
+            c0 = max(tx*size - x0, 0)
+            c1 = min((tx + 1)*size - x0, cols)
+            if r0 >= r1 or c0 >= c1:
+                continue
+            out[r0:r1, c0:c1] = tile[layer][r0 + y0 - ty*size:r1 + y0 - ty*size,
+                                            c0 + x0 - tx*size:c1 + x0 - tx*size]
+        return out
+
+    # Counts of a layer as a rows x cols image of the display extent, visiting
+    # the allocated tiles only.  Cells finer than the image pixels are
+    # averaged over each pixel, counting unallocated cells as zero, and
+    # coarser cells are sampled at the pixel centers.
+    def inset(self, layer, shape):
+        rows, cols = shape[:2]
+        x0, y0, width, height = self.extent
+        pixel_x = width / cols # Pixel size in meters
+        pixel_y = height / rows
+        size = self.tile_size
+        cell = self.cell_size
+        out = np.zeros((rows, cols))
+        cells = np.arange(size)
+        if pixel_x >= cell and pixel_y >= cell:
+            for (ty, tx), tile in self.tiles.items():
+                # Pixel of the center of every tile row and column
+                pix_row = np.floor(((ty*size + cells + 0.5)*cell - y0) / pixel_y).astype(np.int64)
+                pix_col = np.floor(((tx*size + cells + 0.5)*cell - x0) / pixel_x).astype(np.int64)
+                keep_rows = (pix_row >= 0) & (pix_row < rows)
+                keep_cols = (pix_col >= 0) & (pix_col < cols)
+                if not keep_rows.any() or not keep_cols.any():
+                    continue
+                pix_row = pix_row[keep_rows]
+                pix_col = pix_col[keep_cols]
+                r0, c0 = pix_row[0], pix_col[0]
+                n_rows, n_cols = pix_row[-1] - r0 + 1, pix_col[-1] - c0 + 1
+                window = ((pix_row - r0)[:,None]*n_cols + (pix_col - c0)[None,:]).ravel()
+                counts = tile[layer][np.ix_(keep_rows, keep_cols)].ravel()
+                out[r0:r0 + n_rows, c0:c0 + n_cols] += np.bincount(window, weights=counts,
+                                                                   minlength=n_rows*n_cols).reshape(n_rows, n_cols)
+            # Cells whose center falls in each pixel row and column
+            row_cells = np.diff(np.ceil((y0 + np.arange(rows + 1)*pixel_y) / cell - 0.5))
+            col_cells = np.diff(np.ceil((x0 + np.arange(cols + 1)*pixel_x) / cell - 0.5))
+            out /= np.maximum(row_cells[:,None]*col_cells[None,:], 1)
+        else:
+            # Tile cell under the center of every pixel
+            cell_row = np.floor((y0 + (np.arange(rows) + 0.5)*pixel_y) / cell).astype(np.int64)
+            cell_col = np.floor((x0 + (np.arange(cols) + 0.5)*pixel_x) / cell).astype(np.int64)
+            for (ty, tx), tile in self.tiles.items():
+                in_rows = np.flatnonzero(cell_row // size == ty)
+                in_cols = np.flatnonzero(cell_col // size == tx)
+                if len(in_rows) == 0 or len(in_cols) == 0:
+                    continue
+                out[np.ix_(in_rows, in_cols)] = tile[layer][np.ix_(cell_row[in_rows] - ty*size,
+                                                                   cell_col[in_cols] - tx*size)]
+        return out
+
+    # Bounding box (x0, y0, x1, y1) in cells of the allocated tiles
+    def bounds(self):
+        if not self.tiles:
+            return None
+        keys = np.array(list(self.tiles.keys()))
+        size = self.tile_size
+        return (keys[:,1].min()*size, keys[:,0].min()*size,
+                (keys[:,1].max() + 1)*size, (keys[:,0].max() + 1)*size)
+
+    @property
+    def nbytes(self):
+        return sum(tile.nbytes for tile in self.tiles.values())